@@ -5,11 +5,12 @@
 # - thermostat supports auto, manual, fan, heat, cool modes
 # - minimum cycle duration can be set (THERMO_MIN_CYCLE)
 # - swing mode is enabled and can be customized (THERMO_COLD_TOLERANCE and THERMO_HEAT_TOLERANCE)
+# - the update interval adapts to how close the temperature is to a switching threshold (THERMO_ADAPTIVE_UPDATE)
 #
 # Configuration considerations:
 # - Relies on separate config.py file to store secrets (WiFI and MQTT connection details)
-# - Gets actual temperature through ENVII sensor, connected to the Core2. But you could easily set up another
-#   external temperature sensor and communicate values to the Core2 through MQTT
+# - Gets actual temperature through ENVII sensor, connected to the Core2. Remote room sensors can be added over MQTT
+#   (REMOTE_SENSORS) and are combined with the ENVII into one control temperature (SENSOR_FUSION)
 # - Uses MQTT to communicate with relays that turn on/off furnace, fan, and AC. You need to configure the right
 #   topics and payloads to establish that communication (variables starting with RELAY_)
 # - Graphics files for heat/cool/fan need to be stored in the /res directory (from materialdesignicons.com, 24x24 px, R:66, G:165, B:245)
@@ -17,6 +18,8 @@
 # Home Assistant integration:
 # - Integrates with Home Assistant through MQTT (you need MQTT enabled on the HA side)
 # - Supports MQTT auto-discovery. No configuration needed on the HA side.
+# - Unique ids and state/command topics are built from the Core2 MAC address, so several thermostats can share a
+#   broker. Discovery requests are answered after a random delay and rate limited (DISCOVERY_ settings)
 # - Will create 'Core2 Thermostat' device with following entities:
 #    - 3 sensors for temperature, humidity, and pressure (if using the ENVII)
 #    - 1 thermostat entity
@@ -45,6 +48,11 @@ import math
 from numbers import Number
 import lvgl as lv
 import json
+import os
+import utime
+import machine
+import ubinascii
+import random
 import config
 
 # Device information
@@ -52,12 +60,19 @@ ATTR_MANUFACTURER = "M5Stack"
 ATTR_MODEL = "Core 2"
 ATTR_NAME = "Core 2 Thermostat"
 
-# Default topics used to communicate with Home Assistant
+# Per-device identity (the ESP32 MAC address). Used for the MQTT client id and the Home Assistant unique ids,
+# so several thermostats can share a broker
+DEVICE_ID = ubinascii.hexlify(machine.unique_id()).decode()
+
+# Default topics used to communicate with Home Assistant. State and command topics are per device (core2/<DEVICE_ID>/...),
+# so thermostats sharing a broker don't apply each other's commands. Discovery requests can also be sent to the
+# whole fleet at once on DEFAULT_TOPIC_FLEET_DISCOVERY
 DEFAULT_DISC_PREFIX = "homeassistant/"
-DEFAULT_TOPIC_THERMOSTAT_PREFIX = "core2/thermostat/"
-DEFAULT_TOPIC_SENSOR_PREFIX = "core2/env2/"
-DEFAULT_TOPIC_DEBUG = "core2/debug/"
-DEFAULT_TOPIC_SWITCH_PREFIX = "core2/switch/"
+DEFAULT_TOPIC_THERMOSTAT_PREFIX = "core2/%s/thermostat/" % DEVICE_ID
+DEFAULT_TOPIC_SENSOR_PREFIX = "core2/%s/env2/" % DEVICE_ID
+DEFAULT_TOPIC_DEBUG = "core2/%s/debug/" % DEVICE_ID
+DEFAULT_TOPIC_SWITCH_PREFIX = "core2/%s/switch/" % DEVICE_ID
+DEFAULT_TOPIC_FLEET_DISCOVERY = "core2/thermostat/discovery"
 
 # Topics to send/receive commands to other sensors directly
 MASTER_SWITCH_TOPIC = "test-master-switch/switch/master_switch/state"
@@ -73,11 +88,13 @@ DISP_LBL_TARGET_OFFSET = -20
 DISP_LBL_ACTION_OFFSET = -51
 DISP_LBL_MODE_OFFSET = 55
 DISP_TEMPERATURE = "F" # change to "C" if your prefer Celsius
+DISP_BLINK_PERIOD = 305   # ms, blinking of target and action while a change is pending
+DISP_FADE_TIME = 250      # ms, fade-in of mode and action labels when they change
 
 # MQTT connection details
 MQTT_IP = config.MQTT_IP
 MQTT_PORT = config.MQTT_PORT
-MQTT_ID = 'Thermostat'
+MQTT_ID = 'Thermostat-' + DEVICE_ID
 MQTT_USER = config.MQTT_USER
 MQTT_PASS = config.MQTT_PASS
 MQTT_KEEPALIVE = 300
@@ -114,6 +131,7 @@ KEY_MODE_STATE_TEMPLATE = "mode_stat_tpl"
 KEY_PAYLOAD_OFF = "pl_off"
 KEY_PAYLOAD_ON = "pl_on"
 KEY_UNIT_OF_MEASUREMENT = "unit_of_meas"
+KEY_STATE_CLASS = "stat_cla"
 
 # Topic and Payload details used to communicate with the furnace, AC, and fan(s)
 RELAY_HEAT_TOPIC = "core2/heat"
@@ -139,9 +157,12 @@ TOPIC_AC_COMMAND = "ac/command"
 TOPIC_HEATER_STATUS = "heater/status"
 TOPIC_AC_STATUS = "ac/status"
 TOPIC_DISCOVERY = "discovery"
+TOPIC_TRACE_DUMP = "trace/dump"
+TOPIC_STATS = "stats"
 
 # Instructions on how the payload is structured and should be parsed by Home Assistant
 TPL_TEMPERATURE = "{{value_json.temperature}}"
+TPL_CONTROL_TEMPERATURE = "{{value_json.control_temperature}}"
 TPL_PRESSURE = "{{value_json.pressure}}"
 TPL_HUMIDITY = "{{value_json.humidity}}"
 TPL_MODE_STATE = '{% set values = {"off":"off", "auto":"auto", "man":"off", "heat":"heat", "cool":"cool", "fan":"fan_only"} %} {{ values[value] }}'
@@ -158,8 +179,161 @@ THERMO_MIN_CYCLE = 5           # seconds
 THERMO_COLD_TOLERANCE = 0.5      # C
 THERMO_HEAT_TOLERANCE = 0.5      # C
 THERMO_UPDATE_FREQUENCY = 20   # seconds
+THERMO_ADAPTIVE_UPDATE = True  # adapt the update interval to the distance from the switching thresholds (see update_cadence)
+THERMO_MIN_UPDATE_FREQUENCY = 5     # seconds
+THERMO_MAX_UPDATE_FREQUENCY = 120   # seconds
+THERMO_ADAPTIVE_SPAN = 1.0     # C. From this distance to the nearest threshold, the interval is the longest
 THERMO_MODES = ["off", "auto", "man", "heat", "cool", "fan"]
 
+# Remote room sensors, combined with the ENVII into the temperature used for control. Temperature payloads are
+# either a number (C) or JSON with a "temperature" key. Occupancy payloads are ON/OFF (or true/false)
+# eg. {"name": "bedroom", "topic": "bedroom/sensor/state", "weight": 1.0, "occupancy_topic": "bedroom/occupancy"}
+REMOTE_SENSORS = []
+SENSOR_LOCAL_WEIGHT = 1.0      # weight of the ENVII
+SENSOR_FUSION = "mean"         # "mean" (weighted), "min", "max", "occupied" (weighted mean of occupied rooms)
+SENSOR_STALE_TIMEOUT = 600     # seconds. Remote sensors that haven't reported for this long are left out
+
+# Answers to Home Assistant discovery requests (see rcv_discovery)
+DISCOVERY_MAX_JITTER = 10      # seconds, answers are spread randomly over this window
+DISCOVERY_DEDUP_WINDOW = 30    # seconds, requests within this window after an announce are suppressed
+DISCOVERY_BUCKET_SIZE = 3      # max number of announces in a burst
+DISCOVERY_REFILL_TIME = 300    # seconds to earn back one announce
+
+# Entities registered with Home Assistant: (component, object id, component specific configuration)
+DISCOVERY_ENTITIES = [
+    # ENVII Temperature sensor
+    ("sensor", "temp", {
+        KEY_NAME: "Core2 Temperature",
+        KEY_DEVICE_CLASS: "temperature",
+        KEY_UNIT_OF_MEASUREMENT: chr(186) + "C",
+        KEY_STATE_TOPIC: "~" + TOPIC_STATE,
+        "~": DEFAULT_TOPIC_SENSOR_PREFIX,
+        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
+        KEY_VALUE_TEMPLATE: TPL_TEMPERATURE
+        }),
+    # ENVII Pressure sensor
+    ("sensor", "pressure", {
+        KEY_NAME: "Core2 Pressure",
+        KEY_DEVICE_CLASS: "pressure",
+        KEY_UNIT_OF_MEASUREMENT: "hPa",
+        KEY_STATE_TOPIC: "~" + TOPIC_STATE,
+        "~": DEFAULT_TOPIC_SENSOR_PREFIX,
+        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
+        KEY_VALUE_TEMPLATE: TPL_PRESSURE
+        }),
+    # ENVII Humidity sensor
+    ("sensor", "humid", {
+        KEY_NAME: "Core2 Humidity",
+        KEY_DEVICE_CLASS: "humidity",
+        KEY_UNIT_OF_MEASUREMENT: "%",
+        KEY_STATE_TOPIC: "~" + TOPIC_STATE,
+        "~": DEFAULT_TOPIC_SENSOR_PREFIX,
+        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
+        KEY_VALUE_TEMPLATE: TPL_HUMIDITY
+        }),
+    # Core2 as HVAC device
+    ("climate", "thermostat", {
+        KEY_NAME: "Core2 Thermostat",
+        "~": DEFAULT_TOPIC_THERMOSTAT_PREFIX,
+        KEY_ACTION_TOPIC: "~" + TOPIC_ACTION,
+        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
+        KEY_CURRENT_TEMPERATURE_TOPIC: DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATE,
+        KEY_CURRENT_TEMPERATURE_TEMPLATE: TPL_CONTROL_TEMPERATURE,
+        KEY_INITIAL: 20,
+        KEY_MAX_TEMP: THERMO_MAX_TARGET,
+        KEY_MIN_TEMP: THERMO_MIN_TARGET,
+        KEY_MODE_COMMAND_TOPIC: "~" + TOPIC_MODE_COMMAND,
+        KEY_MODE_STATE_TOPIC: "~" + TOPIC_MODE_STATE,
+        KEY_SEND_IF_OFF: True,
+        KEY_TEMPERATURE_COMMAND_TOPIC: "~" + TOPIC_TEMPERATURE_COMMAND,
+        KEY_TEMPERATURE_STATE_TOPIC: "~" + TOPIC_STATE,
+        KEY_TEMPERATURE_UNIT: "C",
+        KEY_MODE_STATE_TEMPLATE: TPL_MODE_STATE
+        }),
+    # Heater for manual control
+    ("switch", "heater", {
+        KEY_NAME: "Core2 Heater",
+        "~": DEFAULT_TOPIC_SWITCH_PREFIX,
+        KEY_PAYLOAD_OFF: RELAY_HEAT_PAYLOAD_OFF,
+        KEY_PAYLOAD_ON: RELAY_HEAT_PAYLOAD_ON,
+        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_HEATER_STATUS,
+        KEY_COMMAND_TOPIC: "~" + TOPIC_HEATER_COMMAND,
+        KEY_STATE_TOPIC: RELAY_HEAT_TOPIC,
+        KEY_ICON: "mdi:radiator"
+        }),
+    # AC for manual control
+    ("switch", "ac", {
+        KEY_NAME: "Core2 AC",
+        "~": DEFAULT_TOPIC_SWITCH_PREFIX,
+        KEY_PAYLOAD_OFF: RELAY_COOL_PAYLOAD_OFF,
+        KEY_PAYLOAD_ON: RELAY_COOL_PAYLOAD_ON,
+        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_AC_STATUS,
+        KEY_COMMAND_TOPIC: "~" + TOPIC_AC_COMMAND,
+        KEY_STATE_TOPIC: RELAY_COOL_TOPIC,
+        KEY_ICON: "mdi:snowflake"
+        })
+    ]
+
+# Runtime accounting per appliance, published on the stats topic: (key, name, unit, icon)
+# Cycles are counted when the appliance turns on, cycle length is the time it stayed on
+STATS_APPLIANCES = ["heating", "cooling", "fan"]
+STATS_SENSORS = [
+    ("runtime", "Runtime", "h", "mdi:timer-outline"),
+    ("cycles_hour", "Cycles Last Hour", None, "mdi:counter"),
+    ("cycles_day", "Cycles Last Day", None, "mdi:counter"),
+    ("duty_day", "Duty Cycle Last Day", "%", "mdi:percent"),
+    ("shortest_cycle", "Shortest Cycle", "s", "mdi:timer-sand"),
+    ("longest_cycle", "Longest Cycle", "s", "mdi:timer-sand-full"),
+    ("blocked", "Blocked By Min Cycle", None, "mdi:timer-lock-outline")
+    ]
+# Thermostat wide metrics, also published on the stats topic
+STATS_DEVICE_SENSORS = [
+    ("update_interval", "Update Interval", "s", "mdi:timer-refresh-outline"),
+    ("touch_latency", "Touch Latency", "ms", "mdi:gesture-tap"),
+    ("touch_latency_max", "Max Touch Latency", "ms", "mdi:gesture-tap")
+    ]
+STATS_HOUR_BUCKETS = 12        # rolling hour in 12 buckets of 5 minutes
+STATS_DAY_BUCKETS = 24         # rolling day in 24 buckets of 1 hour
+
+def stats_entities():
+    entities = []
+    for appliance in STATS_APPLIANCES:
+        for key, name, measure, icon in STATS_SENSORS:
+            entity = {
+                KEY_NAME: "Core2 %s %s" % (appliance[0].upper() + appliance[1:], name),
+                "~": DEFAULT_TOPIC_THERMOSTAT_PREFIX,
+                KEY_STATE_TOPIC: "~" + TOPIC_STATS,
+                KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
+                KEY_VALUE_TEMPLATE: "{{value_json.%s_%s}}" % (appliance, key),
+                KEY_STATE_CLASS: "total_increasing" if key in ("runtime", "blocked") else "measurement",
+                KEY_ICON: icon
+                }
+            if measure:
+                entity[KEY_UNIT_OF_MEASUREMENT] = measure
+            entities.append(("sensor", "%s_%s" % (appliance, key), entity))
+    for key, name, measure, icon in STATS_DEVICE_SENSORS:
+        entities.append(("sensor", key, {
+            KEY_NAME: "Core2 %s" % name,
+            "~": DEFAULT_TOPIC_THERMOSTAT_PREFIX,
+            KEY_STATE_TOPIC: "~" + TOPIC_STATS,
+            KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
+            KEY_VALUE_TEMPLATE: "{{value_json.%s}}" % key,
+            KEY_STATE_CLASS: "measurement",
+            KEY_UNIT_OF_MEASUREMENT: measure,
+            KEY_ICON: icon
+            }))
+    return entities
+
+DISCOVERY_ENTITIES += stats_entities()
+
+# Trace recorder: all inputs (MQTT, sensor readings, buttons, touch, timers) and outputs (MQTT) are logged
+# with a timestamp, so that field incidents can be replayed on a host (see tools/replay.py)
+TRACE_ENABLED = True
+TRACE_BUFFER_SIZE = 2000       # events kept in RAM on the Core2 (oldest are overwritten)
+TRACE_FILE = None              # append-only trace file (host runs). None keeps the trace in the RAM buffer
+TRACE_DUMP_PATH = "/flash/trace.log"   # file the RAM buffer is appended to when a dump is requested over MQTT
+TRACE_DUMP_MAX_SIZE = 262144   # bytes. A larger dump file is moved to TRACE_DUMP_PATH + ".1" before the next dump
+
 screen = M5Screen()
 screen.clean_screen()
 screen.set_screen_bg_color(0x000000)
@@ -199,12 +373,16 @@ btn.add_style(btn.PART.MAIN,styleButton) #define this style
 
 # button press callback action (ie. change thermostat mode)
 def change_mode(btn, event):
-    global src, thermo_state
+    global src, thermo_state, touch_mode_pending
     if(event == lv.EVENT.CLICKED):
+        started = utime.ticks_us()
+        trace_event("i", "touch", "mode")
         btn.set_style_local_bg_color(btn.PART.MAIN, lv.STATE.DEFAULT, lv.color_hex(0xffccf9))
         thermo_state = THERMO_MODES[(THERMO_MODES.index(thermo_state) + 1) % 6]
-        m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_STATE, str(thermo_state)) 
-        thermostat_decision_logic()
+        set_label_text(lbl_mode, thermo_state)
+        lbl_mode.set_align(ALIGN_CENTER, 0, DISP_LBL_MODE_OFFSET)
+        touch_mode_pending = True
+        touch_feedback(started)
     
 # define callback  
 btn.set_event_cb(change_mode)
@@ -225,196 +403,160 @@ lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
 lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_ACTION_OFFSET)
 lbl_mode.set_align(ALIGN_CENTER, 0, DISP_LBL_MODE_OFFSET)
 
+# All display animation runs in LVGL's animation engine (no Python timers):
+# - the "change pending" blink animates the text opacity of the target and action labels with a step path,
+#   so the labels only change twice per period. Starting/stopping it is a single call to set_blink()
+# - mode and action changes fade the new label in (lv_obj_fade_in, a native LVGL animation)
+path_step = lv.anim_path_t()
+path_step.init()
+path_step.set_cb(lv.anim_path_step)
+
+def blink_anim_cb(anim, opa):
+    lbl_target.set_style_local_text_opa(lbl_target.PART.MAIN, lv.STATE.DEFAULT, opa)
+    lbl_action.set_style_local_text_opa(lbl_action.PART.MAIN, lv.STATE.DEFAULT, opa)
+
+# The custom exec callback makes the animation its own var (LVGL 7 sets a->var = a), so the running blink is
+# deleted by anim_blink, not by a label
+anim_blink = lv.anim_t()
+anim_blink.init()
+anim_blink.set_custom_exec_cb(blink_anim_cb)
+anim_blink.set_values(lv.OPA.COVER, lv.OPA.TRANSP)
+anim_blink.set_time(DISP_BLINK_PERIOD)
+anim_blink.set_playback_time(DISP_BLINK_PERIOD)
+anim_blink.set_repeat_count(lv.ANIM_REPEAT.INFINITE)
+anim_blink.set_path(path_step)
+
+blink = 0
+
+def set_blink(on):
+    global blink
+    if on == blink:
+        return
+    blink = on
+    if on:
+        lv.anim_start(anim_blink)
+    else:
+        lv.anim_del(anim_blink, None)
+        blink_anim_cb(anim_blink, lv.OPA.COVER)
+
+# Touch input is handled in two stages, so the screen answers within one LVGL frame however slow the broker is:
+# - the touch callbacks only update the touched widgets and refresh the screen right away
+# - publishing and the decision logic (relays, full redraw) run on the next main loop pass (main_loop_step)
+# The time from the touch event to the end of the refresh is published as the touch latency.
+def touch_feedback(started):
+    lv.refr_now(None)
+    touch_latency_record(utime.ticks_diff(utime.ticks_us(), started))
+
+# Measured latencies are traced as inputs, so replays publish the recorded ones
+def touch_latency_record(latency):
+    global touch_latency, touch_latency_max
+    trace_event("i", "touch", "latency", latency)
+    touch_latency = latency
+    touch_latency_max = latency if touch_latency_max is None else max(touch_latency_max, latency)
+
+def set_label_text(label, text):
+    if label.get_text() != text:
+        label.set_text(text)
+        label.fade_in(DISP_FADE_TIME, 0)
+
 # Setup initial comms and register with Home Assistant (through auto-discovery)
 def comms_init():
-    global m5mqtt
+    global m5mqtt, discovery_tokens, discovery_refilled, discovery_pending, discovery_suppressed
     wifiCfg.doConnect(WIFI_SSID, WIFI_PASS)
     m5mqtt = M5mqtt(MQTT_ID, MQTT_IP, MQTT_PORT, MQTT_USER, MQTT_PASS, MQTT_KEEPALIVE)
     
     # Subscribe to HA thermostat mode changes
-    m5mqtt.subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_COMMAND, rcv_thermo_state)
+    mqtt_subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_COMMAND, rcv_thermo_state)
     
     # Subscribe to HA target temperature changes
-    m5mqtt.subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_TEMPERATURE_COMMAND, rcv_target_temp)
+    mqtt_subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_TEMPERATURE_COMMAND, rcv_target_temp)
 
     # Subscribe to HA manual heater changes
-    m5mqtt.subscribe(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_HEATER_COMMAND, rcv_heater_status)    
+    mqtt_subscribe(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_HEATER_COMMAND, rcv_heater_status)    
     
     # Subscribe to HA manual AC changes
-    m5mqtt.subscribe(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_AC_COMMAND, rcv_ac_status)     
+    mqtt_subscribe(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_AC_COMMAND, rcv_ac_status)     
 
     # Subscribe to Master OFF switch commands
-    m5mqtt.subscribe(MASTER_SWITCH_TOPIC, rcv_master_off)         
+    mqtt_subscribe(MASTER_SWITCH_TOPIC, rcv_master_off)         
+
+    # Subscribe to Home Assistant registration requests (for this thermostat and for the whole fleet)
+    mqtt_subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_DISCOVERY, rcv_discovery)
+    mqtt_subscribe(DEFAULT_TOPIC_FLEET_DISCOVERY, rcv_discovery)
 
-    # Subscribe to Home Assistant registration requests
-    m5mqtt.subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_DISCOVERY, rcv_discovery)
+    # Subscribe to trace dump requests
+    mqtt_subscribe(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_TRACE_DUMP, rcv_trace_dump)
+
+    # Subscribe to remote room sensors
+    for sensor in REMOTE_SENSORS:
+        mqtt_subscribe(sensor["topic"], remote_sensor_callback(sensor["name"]))
+        if sensor.get("occupancy_topic"):
+            mqtt_subscribe(sensor["occupancy_topic"], occupancy_callback(sensor["name"]))
     
     m5mqtt.start()
+    discovery_tokens = DISCOVERY_BUCKET_SIZE
+    discovery_refilled = utime.time()
+    discovery_pending = False
+    discovery_suppressed = 0
     mqtt_registration()
     mqtt_initialization()
 
-def mqtt_registration():
-    # Register ENVII Temperature sensor with Home Assistant
-    topic = "%ssensor/core2/core2-temp/config" % DEFAULT_DISC_PREFIX
-    payload = {        
-        KEY_NAME: "Core2 Temperature",
-        KEY_PAYLOAD_AVAILABLE: "on",
-        KEY_PAYLOAD_NOT_AVAILABLE: "off",
-        KEY_DEVICE_CLASS: "temperature",
-        KEY_UNIQUE_ID: "12234",
-        KEY_DEVICE: {
-            KEY_IDENTIFIERS: ["12234"],
-            KEY_NAME: ATTR_NAME,
-            KEY_MODEL: ATTR_MODEL,
-            KEY_MANUFACTURER: ATTR_MANUFACTURER
-        },
-        KEY_UNIT_OF_MEASUREMENT: chr(186) + "C",
-        KEY_STATE_TOPIC: "~" + TOPIC_STATE,
-        "~": DEFAULT_TOPIC_SENSOR_PREFIX,
-        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
-        KEY_VALUE_TEMPLATE: TPL_TEMPERATURE
-    }
-    m5mqtt.publish(topic, json.dumps(payload).encode('utf-8'))
+# All MQTT traffic goes through these two helpers so that it ends up in the trace
+def mqtt_subscribe(topic, callback):
+    def traced_callback(topic_data):
+        trace_event("i", "mqtt", topic, topic_data)
+        callback(topic_data)
+    m5mqtt.subscribe(topic, traced_callback)
 
-    # Register ENVII Pressure sensor with Home Assistant
-    topic = "%ssensor/core2/core2-pressure/config" % DEFAULT_DISC_PREFIX
-    payload = {        
-        KEY_NAME: "Core2 Pressure",
-        KEY_PAYLOAD_AVAILABLE: "on",
-        KEY_PAYLOAD_NOT_AVAILABLE: "off",
-        KEY_DEVICE_CLASS: "pressure",
-        KEY_UNIQUE_ID: "122346",
-        KEY_DEVICE: {
-            KEY_IDENTIFIERS: ["12234"],
-            KEY_NAME: ATTR_NAME,
-            KEY_MODEL: ATTR_MODEL,
-            KEY_MANUFACTURER: ATTR_MANUFACTURER
-        },
-        KEY_UNIT_OF_MEASUREMENT: "hPa",        
-        KEY_STATE_TOPIC: "~" + TOPIC_STATE,
-        "~": DEFAULT_TOPIC_SENSOR_PREFIX,
-        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
-        KEY_VALUE_TEMPLATE: TPL_PRESSURE
-    }
-    m5mqtt.publish(topic, str(json.dumps(payload)))    
+def mqtt_publish(topic, payload):
+    trace_event("o", "mqtt", topic, payload if isinstance(payload, str) else payload.decode('utf-8'))
+    m5mqtt.publish(topic, payload)
 
-    # Register ENVII Humidity sensor with Home Assistant
-    topic = "%ssensor/core2/core2-humid/config" % DEFAULT_DISC_PREFIX
-    payload = {        
-        KEY_NAME: "Core2 Humidity",
-        KEY_PAYLOAD_AVAILABLE: "on",
-        KEY_PAYLOAD_NOT_AVAILABLE: "off",
-        KEY_DEVICE_CLASS: "humidity",
-        KEY_UNIQUE_ID: "122347",
-        KEY_DEVICE: {
-            KEY_IDENTIFIERS: ["12234"],
-            KEY_NAME: ATTR_NAME,
-            KEY_MODEL: ATTR_MODEL,
-            KEY_MANUFACTURER: ATTR_MANUFACTURER
-        },
-        KEY_UNIT_OF_MEASUREMENT: "%", 
-        KEY_STATE_TOPIC: "~" + TOPIC_STATE,
-        "~": DEFAULT_TOPIC_SENSOR_PREFIX,
-        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
-        KEY_VALUE_TEMPLATE: TPL_HUMIDITY
-    }
-    m5mqtt.publish(topic, str(json.dumps(payload)))
- 
-    # Register Core2 as HVAC device with Home Assistant
-    topic = "%sclimate/core2/config" % DEFAULT_DISC_PREFIX
-    payload = {
-        KEY_NAME: "Core2 Thermostat",
-        KEY_PAYLOAD_AVAILABLE: "on",
-        KEY_PAYLOAD_NOT_AVAILABLE: "off",
-        KEY_UNIQUE_ID: "122348",
-        KEY_DEVICE: {
-            KEY_IDENTIFIERS: ["12234"],
-            KEY_NAME: ATTR_NAME,
-            KEY_MODEL: ATTR_MODEL,
-            KEY_MANUFACTURER: ATTR_MANUFACTURER
-        },
-        "~": DEFAULT_TOPIC_THERMOSTAT_PREFIX,
-        KEY_ACTION_TOPIC: "~" + TOPIC_ACTION,
-        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_STATUS,
-        KEY_CURRENT_TEMPERATURE_TOPIC: DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATE,
-        KEY_CURRENT_TEMPERATURE_TEMPLATE: TPL_TEMPERATURE,
-        KEY_INITIAL: 20,
-        KEY_MAX_TEMP: THERMO_MAX_TARGET,
-        KEY_MIN_TEMP: THERMO_MIN_TARGET,
-        KEY_MODE_COMMAND_TOPIC: "~" + TOPIC_MODE_COMMAND,
-        KEY_MODE_STATE_TOPIC: "~" + TOPIC_MODE_STATE,
-        KEY_SEND_IF_OFF: True,
-        KEY_TEMPERATURE_COMMAND_TOPIC: "~" + TOPIC_TEMPERATURE_COMMAND,
-        KEY_TEMPERATURE_STATE_TOPIC: "~" + TOPIC_STATE,
-        KEY_TEMPERATURE_UNIT: "C",
-        KEY_MODE_STATE_TEMPLATE: TPL_MODE_STATE
+# Register all entities in DISCOVERY_ENTITIES with Home Assistant. Unique ids and discovery topics are built from
+# DEVICE_ID, the keys shared by all entities (availability payloads, device) are added here
+def mqtt_registration():
+    for component, object_id, config in DISCOVERY_ENTITIES:
+        topic = "%s%s/core2-%s/%s/config" % (DEFAULT_DISC_PREFIX, component, DEVICE_ID, object_id)
+        payload = {
+            KEY_PAYLOAD_AVAILABLE: "on",
+            KEY_PAYLOAD_NOT_AVAILABLE: "off",
+            KEY_UNIQUE_ID: "%s-%s" % (DEVICE_ID, object_id),
+            KEY_DEVICE: {
+                KEY_IDENTIFIERS: [DEVICE_ID],
+                KEY_NAME: "%s %s" % (ATTR_NAME, DEVICE_ID[-4:]),
+                KEY_MODEL: ATTR_MODEL,
+                KEY_MANUFACTURER: ATTR_MANUFACTURER
+            }
         }
-    m5mqtt.publish(topic, str(json.dumps(payload)))
+        payload.update(config)
+        mqtt_publish(topic, str(json.dumps(payload)))
 
-    # Register Heater for manual control with Home Assistant
-    topic = "%sswitch/core2/core2-heater/config" % DEFAULT_DISC_PREFIX
-    payload = {
-        KEY_NAME: "Core2 Heater",
-        KEY_PAYLOAD_AVAILABLE: "on",
-        KEY_PAYLOAD_NOT_AVAILABLE: "off",
-        KEY_UNIQUE_ID: "122349",
-        KEY_DEVICE: {
-            KEY_IDENTIFIERS: ["12234"],
-            KEY_NAME: ATTR_NAME,
-            KEY_MODEL: ATTR_MODEL,
-            KEY_MANUFACTURER: ATTR_MANUFACTURER
-        },
-        "~": DEFAULT_TOPIC_SWITCH_PREFIX,
-        KEY_PAYLOAD_OFF: RELAY_HEAT_PAYLOAD_OFF,
-        KEY_PAYLOAD_ON: RELAY_HEAT_PAYLOAD_ON,
-        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_HEATER_STATUS,
-        KEY_COMMAND_TOPIC: "~" + TOPIC_HEATER_COMMAND,
-        KEY_STATE_TOPIC: RELAY_HEAT_TOPIC,
-        KEY_ICON: "mdi:radiator"
-        }
-    m5mqtt.publish(topic, str(json.dumps(payload)))    
-        
-    # Register AC for manual control with Home Assistant
-    topic = "%sswitch/core2/core2-ac/config" % DEFAULT_DISC_PREFIX
-    payload = {
-        KEY_NAME: "Core2 AC",
-        KEY_PAYLOAD_AVAILABLE: "on",
-        KEY_PAYLOAD_NOT_AVAILABLE: "off",
-        KEY_UNIQUE_ID: "122350",
-        KEY_DEVICE: {
-            KEY_IDENTIFIERS: ["12234"],
-            KEY_NAME: ATTR_NAME,
-            KEY_MODEL: ATTR_MODEL,
-            KEY_MANUFACTURER: ATTR_MANUFACTURER
-        },
-        "~": DEFAULT_TOPIC_SWITCH_PREFIX,
-        KEY_PAYLOAD_OFF: RELAY_COOL_PAYLOAD_OFF,
-        KEY_PAYLOAD_ON: RELAY_COOL_PAYLOAD_ON,
-        KEY_AVAILABILITY_TOPIC: "~" + TOPIC_AC_STATUS,
-        KEY_COMMAND_TOPIC: "~" + TOPIC_AC_COMMAND,
-        KEY_STATE_TOPIC: RELAY_COOL_TOPIC,
-        KEY_ICON: "mdi:snowflake"
-        }
-    m5mqtt.publish(topic, str(json.dumps(payload)))
+# Send Availability notices to Home Assistant
+def mqtt_availability():
+    mqtt_publish(DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATUS, "on")
+    mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATUS, "on")
+    mqtt_publish(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_HEATER_STATUS, "on")
+    mqtt_publish(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_AC_STATUS, "on")
 
 def mqtt_initialization():
-    # Send Availability notices to Home Assistant
-    m5mqtt.publish(DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATUS, "on")
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATUS, "on")
-    m5mqtt.publish(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_HEATER_STATUS, "on")
-    m5mqtt.publish(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_AC_STATUS, "on")
+    global discovery_announced
+    mqtt_availability()
+    discovery_announced = utime.time()
     
     # Send initial state information to Home Assistant
     update_mqtt_state_topics()
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
-    m5mqtt.publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
-    m5mqtt.publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
+    mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
+    mqtt_publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
+    mqtt_publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
     
 def thermostat_init():
-    global action, actual_temp, blink, change_ignored, cycle, delay, ticks, thermo_state, fan_state, cooling_state, heating_state, target_temp, manual_command
+    global action, actual_temp, change_ignored, cycle, delay, ticks, thermo_state, fan_state, cooling_state, heating_state, target_temp, manual_command
+    global update_interval, temp_trend, trend_temp, trend_ms
+    global touch_mode_pending, touch_target_pending, touch_latency, touch_latency_max
     action = 0
-    actual_temp = env20.temperature
-    blink = 0
+    sensors_init()
+    stats_init()
+    actual_temp = read_control_temperature()
     change_ignored = 0
     cycle = 0
     delay = 0      # initial delay of 10s so that user can select the right mode without appliances suddenly turning on
@@ -423,6 +565,14 @@ def thermostat_init():
     thermo_state = THERMO_MODES[0]
     target_temp = slider_target.get_value()
     ticks = 0
+    update_interval = THERMO_UPDATE_FREQUENCY
+    temp_trend = 0
+    trend_temp = actual_temp
+    trend_ms = utime.ticks_ms()
+    touch_mode_pending = False
+    touch_target_pending = False
+    touch_latency = None
+    touch_latency_max = None
     
     # initial state of thermostat is OFF and all appliances are OFF
     fan_state = 0
@@ -430,10 +580,256 @@ def thermostat_init():
     heating_state = 0
     manual_command = 0
 
+# Trace events are stored as [ticks_ms, direction ("i"/"o"), kind, key, value]. On the Core2 they go into a
+# fixed-size ring buffer, on a host they are appended to TRACE_FILE as one JSON line per event.
+trace_buffer = [None] * TRACE_BUFFER_SIZE
+trace_next = 0
+trace_file = None
+
+def trace_init():
+    global trace_file
+    if TRACE_ENABLED and TRACE_FILE:
+        trace_file = open(TRACE_FILE, "a")
+    trace_event("i", "boot", "start")
+
+def trace_event(direction, kind, key, value=None):
+    global trace_next
+    if not TRACE_ENABLED:
+        return
+    event = [utime.ticks_ms(), direction, kind, key, value]
+    if trace_file:
+        trace_file.write(json.dumps(event) + "\n")
+        trace_file.flush()
+    else:
+        trace_buffer[trace_next] = event
+        trace_next = (trace_next + 1) % TRACE_BUFFER_SIZE
+
+# Snapshot of the thermostat state, recorded at every periodic update so that a replay can start from a
+# RAM buffer dump that no longer contains the boot sequence
+def trace_snapshot():
+    trace_event("i", "snapshot", "state", {
+        "thermo_state": thermo_state,
+        "target_temp": slider_target.get_value(),
+        "actual_temp": actual_temp,
+        "heating_state": heating_state,
+        "cooling_state": cooling_state,
+        "fan_state": fan_state,
+        "manual_command": manual_command,
+        "change_ignored": change_ignored,
+        "delay": delay,
+        "ticks": ticks,
+        "update_interval": update_interval,
+        "temp_trend": temp_trend,
+        "trend_temp": trend_temp,
+        "trend_ms": trend_ms,
+        "sensors": sensors_snapshot(),
+        "occupied": dict(sensor_occupied),
+        "sensor_sum": sensor_sum,
+        "sensor_weight": sensor_weight,
+        "occupied_sum": occupied_sum,
+        "occupied_weight": occupied_weight
+        })
+
+# Keep two dump files on flash: the current one and the previous one (TRACE_DUMP_PATH + ".1")
+def trace_dump_rotate():
+    try:
+        if os.stat(TRACE_DUMP_PATH)[6] < TRACE_DUMP_MAX_SIZE:
+            return
+    except OSError:
+        return
+    try:
+        os.remove(TRACE_DUMP_PATH + ".1")
+    except OSError:
+        pass
+    os.rename(TRACE_DUMP_PATH, TRACE_DUMP_PATH + ".1")
+
+# Append the RAM buffer (oldest event first) to TRACE_DUMP_PATH and start a fresh buffer
+def trace_dump():
+    global trace_buffer, trace_next
+    if not TRACE_ENABLED or trace_file:
+        return
+    trace_dump_rotate()
+    with open(TRACE_DUMP_PATH, "a") as f:
+        for i in range(TRACE_BUFFER_SIZE):
+            event = trace_buffer[(trace_next + i) % TRACE_BUFFER_SIZE]
+            if event is not None:
+                f.write(json.dumps(event) + "\n")
+    trace_buffer = [None] * TRACE_BUFFER_SIZE
+    trace_next = 0
+
+def read_sensor(name):
+    value = getattr(env20, name)
+    trace_event("i", "sensor", name, value)
+    return value
+
+# Sensor fusion: the ENVII ("local") and the remote room sensors are combined into one control temperature.
+# Every reading updates running sums (weighted mean, also restricted to occupied rooms), so the work per reading
+# and per decision doesn't depend on the number of sensors. The remote sensors that have a reading are kept in a
+# linked list ordered by the time of their latest reading (a reading moves the sensor to the tail), so stale sensors
+# are dropped from the head in O(1) each and the list never holds more than one entry per sensor.
+# min/max keep the current extreme and only rescan the sensors when the extreme itself rises/falls or expires.
+def sensors_init():
+    global sensor_values, sensor_weights, sensor_stamps, sensor_occupied, sensor_sum, sensor_weight
+    global occupied_sum, occupied_weight, sensor_min, sensor_max
+    global sensor_expiry_prev, sensor_expiry_next, sensor_expiry_head, sensor_expiry_tail
+    sensor_values = {}
+    sensor_weights = {"local": SENSOR_LOCAL_WEIGHT}
+    sensor_stamps = {}
+    sensor_occupied = {}
+    for sensor in REMOTE_SENSORS:
+        sensor_weights[sensor["name"]] = sensor.get("weight", 1.0)
+        sensor_occupied[sensor["name"]] = False
+    sensor_sum = 0
+    sensor_weight = 0
+    occupied_sum = 0
+    occupied_weight = 0
+    sensor_min = None
+    sensor_max = None
+    sensor_expiry_prev = {}
+    sensor_expiry_next = {}
+    sensor_expiry_head = None
+    sensor_expiry_tail = None
+
+def sensor_add(name, value, sign):
+    global sensor_sum, sensor_weight, occupied_sum, occupied_weight
+    weight = sensor_weights[name] * sign
+    sensor_sum += weight * value
+    sensor_weight += weight
+    if sensor_occupied.get(name):
+        occupied_sum += weight * value
+        occupied_weight += weight
+
+def sensor_extremes(name, value, old):
+    global sensor_min, sensor_max
+    if sensor_min == name:
+        if old is not None and value > old:
+            sensor_min = min(sensor_values, key=sensor_values.get)
+    elif sensor_min is None or value <= sensor_values[sensor_min]:
+        sensor_min = name
+    if sensor_max == name:
+        if old is not None and value < old:
+            sensor_max = max(sensor_values, key=sensor_values.get)
+    elif sensor_max is None or value >= sensor_values[sensor_max]:
+        sensor_max = name
+
+def sensor_expiry_unlink(name):
+    global sensor_expiry_head, sensor_expiry_tail
+    before = sensor_expiry_prev.pop(name)
+    after = sensor_expiry_next.pop(name)
+    if before is None:
+        sensor_expiry_head = after
+    else:
+        sensor_expiry_next[before] = after
+    if after is None:
+        sensor_expiry_tail = before
+    else:
+        sensor_expiry_prev[after] = before
+
+def sensor_expiry_append(name):
+    global sensor_expiry_head, sensor_expiry_tail
+    sensor_expiry_prev[name] = sensor_expiry_tail
+    sensor_expiry_next[name] = None
+    if sensor_expiry_tail is None:
+        sensor_expiry_head = name
+    else:
+        sensor_expiry_next[sensor_expiry_tail] = name
+    sensor_expiry_tail = name
+
+def sensor_update(name, value):
+    old = sensor_values.get(name)
+    if old is not None:
+        sensor_add(name, old, -1)
+    sensor_values[name] = value
+    sensor_add(name, value, 1)
+    sensor_extremes(name, value, old)
+    if name != "local":
+        sensor_stamps[name] = utime.ticks_ms()
+        if name in sensor_expiry_prev:
+            sensor_expiry_unlink(name)
+        sensor_expiry_append(name)
+
+def sensor_remove(name):
+    global sensor_sum, sensor_weight, occupied_sum, occupied_weight, sensor_min, sensor_max
+    sensor_add(name, sensor_values.pop(name), -1)
+    if not sensor_values:
+        sensor_sum = sensor_weight = occupied_sum = occupied_weight = 0
+    if sensor_min == name:
+        sensor_min = min(sensor_values, key=sensor_values.get) if sensor_values else None
+    if sensor_max == name:
+        sensor_max = max(sensor_values, key=sensor_values.get) if sensor_values else None
+
+def sensors_expire():
+    now = utime.ticks_ms()
+    while (sensor_expiry_head is not None and
+           utime.ticks_diff(now, sensor_stamps[sensor_expiry_head]) >= SENSOR_STALE_TIMEOUT * 1000):
+        name = sensor_expiry_head
+        sensor_expiry_unlink(name)
+        sensor_remove(name)
+
+# Sensor readings for trace snapshots: name -> [value, age in ms (None for the ENVII)]
+def sensors_snapshot():
+    now = utime.ticks_ms()
+    sensors = {}
+    for name in sensor_values:
+        age = utime.ticks_diff(now, sensor_stamps[name]) if name in sensor_stamps else None
+        sensors[name] = [sensor_values[name], age]
+    return sensors
+
+def sensor_set_occupied(name, occupied):
+    global occupied_sum, occupied_weight
+    if sensor_occupied.get(name) == occupied:
+        return
+    if name in sensor_values:
+        weight = sensor_weights[name] if occupied else -sensor_weights[name]
+        occupied_sum += weight * sensor_values[name]
+        occupied_weight += weight
+    sensor_occupied[name] = occupied
+
+def fused_temperature():
+    sensors_expire()
+    if SENSOR_FUSION == "min" and sensor_min is not None:
+        return sensor_values[sensor_min]
+    if SENSOR_FUSION == "max" and sensor_max is not None:
+        return sensor_values[sensor_max]
+    if SENSOR_FUSION == "occupied" and occupied_weight > 0:
+        return occupied_sum / occupied_weight
+    if sensor_weight > 0:
+        return sensor_sum / sensor_weight
+    return sensor_values["local"]
+
+# Read the ENVII and return the control temperature
+def read_control_temperature():
+    sensor_update("local", read_sensor("temperature"))
+    return fused_temperature()
+
+# Remote temperatures outside THERMO_MIN_TEMP..THERMO_MAX_TEMP (or NaN/inf) are rejected: a single NaN would stay in
+# the running sums for good
+def parse_temperature(topic_data):
+    try:
+        value = float(topic_data)
+    except ValueError:
+        value = float(json.loads(topic_data)["temperature"])
+    if not THERMO_MIN_TEMP <= value <= THERMO_MAX_TEMP:
+        raise ValueError("temperature out of range")
+    return value
+
+def remote_sensor_callback(name):
+    def rcv_remote_sensor(topic_data):
+        try:
+            sensor_update(name, parse_temperature(topic_data))
+        except (ValueError, KeyError, TypeError):
+            pass
+    return rcv_remote_sensor
+
+def occupancy_callback(name):
+    def rcv_occupancy(topic_data):
+        sensor_set_occupied(name, str(topic_data).lower() in ("on", "true", "1", "occupied"))
+    return rcv_occupancy
+
 # update display everytime there is a change (due to incoming HA info, screen interaction, or sensor data changes)
 def update_display():
     lcd.clear()
-    lbl_mode.set_text(thermo_state)
+    set_label_text(lbl_mode, thermo_state)
     lbl_mode.set_align(ALIGN_CENTER, 0, DISP_LBL_MODE_OFFSET)
     target_temp_display = round(target_temp if DISP_TEMPERATURE == "C" else target_temp * 9 / 5 + 32)
     actual_temp_display = actual_temp if DISP_TEMPERATURE == "C" else actual_temp * 9 / 5 + 32
@@ -448,44 +844,24 @@ def update_display():
         lbl_target.set_text_color(0xffffff)
         lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
         if heating_state ==1:
-            lbl_action.set_text('HEATING')
+            set_label_text(lbl_action, 'HEATING')
             lbl_action.set_text_color(DISP_COLOR_HEAT)
             lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
-            lbl_action.set_text_color(DISP_COLOR_HEAT)
-            if change_ignored == 1:
-                timerSch.run("blink_now", 305, 0x00)
-            else:
-                timerSch.stop("blink_now")
-                lbl_target.set_text_color(DISP_COLOR_HEAT)
+            lbl_target.set_text_color(DISP_COLOR_HEAT)
         elif cooling_state ==1:
-            lbl_action.set_text('COOLING')
+            set_label_text(lbl_action, 'COOLING')
             lbl_action.set_text_color(DISP_COLOR_COOL)
             lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
             lbl_target.set_text_color(DISP_COLOR_COOL)
-            if change_ignored == 1:
-                timerSch.run("blink_now", 305, 0x00)
-            else:
-                timerSch.stop("blink_now")
-                lbl_target.set_text_color(DISP_COLOR_COOL)    
         elif fan_state ==1:
-            lbl_action.set_text('FAN')
+            set_label_text(lbl_action, 'FAN')
             lbl_action.set_text_color(0xffffff)
             lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
             lbl_target.set_text_color(0xffffff)
-            if change_ignored == 1:
-                timerSch.run("blink_now", 305, 0x00)
-            else:
-                timerSch.stop("blink_now")
-                lbl_target.set_text_color(0xffffff)
         else:
-            lbl_action.set_text('IDLE')
+            set_label_text(lbl_action, 'IDLE')
             lbl_action.set_text_color(0xffffff)
             lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
-            if change_ignored == 1:
-                timerSch.run("blink_now", 305, 0x00)
-            else:
-                timerSch.stop("blink_now")
-                lbl_target.set_text_color(0xffffff)            
     else:
         img_BtnA.set_hidden(True)
         img_BtnB.set_hidden(True)
@@ -494,70 +870,53 @@ def update_display():
     # If mode is off
     if thermo_state == THERMO_MODES[0] and change_ignored == 0:
         lcd.font(lcd.FONT_DejaVu40)
-        lbl_action.set_text('')
+        set_label_text(lbl_action, '')
         lbl_target.set_text("---")
         lbl_target.set_text_color(0xffffff)
         lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
         
     # If cooling is on
     elif cooling_state == 1 and thermo_state != THERMO_MODES[2]:
-        lbl_action.set_text('COOLING')
+        set_label_text(lbl_action, 'COOLING')
         lbl_action.set_text_color(DISP_COLOR_COOL)
         lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_ACTION_OFFSET)
         lbl_target.set_text(str(target_temp_display))
         lbl_target.set_text_color(DISP_COLOR_COOL)
         lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
         slider_target.set_hidden(False)
-        if change_ignored == 1:
-            timerSch.run("blink_now", 305, 0x00)
-        else:
-            timerSch.stop("blink_now")
-            lbl_target.set_text_color(DISP_COLOR_COOL)
         
     # if heating is on
     elif heating_state == 1 and thermo_state != THERMO_MODES[2]:
-        lbl_action.set_text('HEATING')
+        set_label_text(lbl_action, 'HEATING')
         lbl_action.set_text_color(DISP_COLOR_HEAT)
         lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_ACTION_OFFSET)
         lbl_target.set_text(str(target_temp_display))
         lbl_target.set_text_color(DISP_COLOR_HEAT)
         lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
         slider_target.set_hidden(False)
-        if change_ignored == 1:
-            timerSch.run("blink_now", 305, 0x00)
-        else:
-            timerSch.stop("blink_now")
-            lbl_target.set_text_color(DISP_COLOR_HEAT)
 
     # if fan is on
     elif fan_state == 1 and thermo_state != THERMO_MODES[2]:
-        lbl_action.set_text('FAN')
+        set_label_text(lbl_action, 'FAN')
         lbl_action.set_text_color(0xffffff)
         lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_ACTION_OFFSET)
         lbl_target.set_text(str(target_temp_display))
         lbl_target.set_text_color(0xffffff)
         lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
         slider_target.set_hidden(False)
-        if change_ignored == 1:
-            timerSch.run("blink_now", 305, 0x00)
-        else:
-            timerSch.stop("blink_now")
-            lbl_target.set_text_color(0xffffff)
             
    # if none of the above conditions are true (ie. thermostat is on, but idle)   
     elif thermo_state != THERMO_MODES[2]:
-        lbl_action.set_text('IDLE')
+        set_label_text(lbl_action, 'IDLE')
         lbl_action.set_text_color(0xffffff)
         lbl_action.set_align(ALIGN_CENTER, 0, DISP_LBL_ACTION_OFFSET)
         lbl_target.set_text(str(target_temp_display))
         lbl_target.set_text_color(0xffffff)
         lbl_target.set_align(ALIGN_CENTER, 0, DISP_LBL_TARGET_OFFSET)
         slider_target.set_hidden(False)
-        if change_ignored == 1:
-            timerSch.run("blink_now", 305, 0x00)
-        else:
-            timerSch.stop("blink_now")
-            lbl_target.set_text_color(0xffffff)
+
+    # blink while a change is pending (min cycle duration not met)
+    set_blink(change_ignored)
             
 # Draw the temperature arc
     t = THERMO_MIN_TEMP
@@ -606,8 +965,9 @@ def update_display():
 
 def thermostat_decision_logic():
     global actual_temp, target_temp, manual_command
-    actual_temp = env20.temperature
+    actual_temp = read_control_temperature()
     target_temp = slider_target.get_value()
+    update_cadence()
     
     if thermo_state == THERMO_MODES[2]: 
         if manual_command == "heating on" and heating_state == 0:
@@ -623,7 +983,6 @@ def thermostat_decision_logic():
         elif manual_command == "fan off" and fan_state == 1:
             change_to("fan off")
         else:
-            timerSch.stop("blink_now")
             update_display()
         return
     
@@ -666,116 +1025,252 @@ def thermostat_decision_logic():
         change_to ("fan off")
     else:
         # no action
-        timerSch.stop("blink_now")
         update_display()
 
+# Adaptive update cadence. The interval until the next periodic update depends on the distance between the
+# control temperature and the nearest switching threshold of the current mode, and on the temperature trend
+# measured between periodic updates:
+# - it grows with the distance, up to THERMO_MAX_UPDATE_FREQUENCY from THERMO_ADAPTIVE_SPAN away
+# - when the temperature moves towards a threshold, the update comes halfway to the expected crossing
+# - when it moves away from all thresholds, it is never shorter than THERMO_UPDATE_FREQUENCY
+# Off and manual modes don't depend on the temperature, so they use the longest interval.
+def switching_thresholds():
+    thresholds = []
+    if thermo_state in [THERMO_MODES[index] for index in [1,3]]:
+        thresholds.append(target_temp - THERMO_COLD_TOLERANCE)
+    if thermo_state in [THERMO_MODES[index] for index in [1,4,5]]:
+        thresholds.append(target_temp + THERMO_HEAT_TOLERANCE)
+    if thresholds and (heating_state == 1 or cooling_state == 1 or fan_state == 1):
+        thresholds.append(target_temp)
+    return thresholds
+
+def update_cadence():
+    global update_interval
+    if not THERMO_ADAPTIVE_UPDATE:
+        update_interval = THERMO_UPDATE_FREQUENCY
+        return
+    thresholds = switching_thresholds()
+    interval = THERMO_MAX_UPDATE_FREQUENCY
+    approaching = False
+    for threshold in thresholds:
+        distance = threshold - actual_temp
+        interval = min(interval, THERMO_MAX_UPDATE_FREQUENCY * abs(distance) / THERMO_ADAPTIVE_SPAN)
+        if distance * temp_trend > 0:
+            approaching = True
+            interval = min(interval, distance / temp_trend / 2)
+    if thresholds and not approaching:
+        interval = max(interval, THERMO_UPDATE_FREQUENCY)
+    update_interval = int(min(THERMO_MAX_UPDATE_FREQUENCY, max(THERMO_MIN_UPDATE_FREQUENCY, interval)))
+
+# Temperature trend in C per second since the previous periodic update
+def update_trend():
+    global temp_trend, trend_temp, trend_ms
+    now = utime.ticks_ms()
+    elapsed = utime.ticks_diff(now, trend_ms) / 1000
+    if elapsed > 0:
+        temp_trend = (actual_temp - trend_temp) / elapsed
+    trend_temp = actual_temp
+    trend_ms = now
+
 # Here's where the appliances are turned on/off using MQTT messages.
 # Here's where we also check for minimum cycle time and ignore change requests
 #  if the minimum cycle time hasn't been reached.
 def change_to (action):
-    global change_ignored, heating_state, cooling_state, fan_state, m5mqtt, delay
+    global change_ignored, heating_state, cooling_state, fan_state, m5mqtt, delay, blocked_action
     if delay == 0 or THERMO_MIN_CYCLE == 0:
         change_ignored = 0
+        blocked_action = None
+        previous_states = (heating_state, cooling_state, fan_state)
         if action == "heating on":
-            m5mqtt.publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_ON)
-            m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "heating") 
+            mqtt_publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_ON)
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "heating") 
             heating_state = 1
             if cooling_state == 1:
-                m5mqtt.publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
+                mqtt_publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
                 cooling_state = 0
             if fan_state == 1:
-                m5mqtt.publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_OFF)
+                mqtt_publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_OFF)
                 fan_state = 0
         elif action == "cooling on":
-            m5mqtt.publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_ON)
-            m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "cooling") 
+            mqtt_publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_ON)
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "cooling") 
             cooling_state = 1
             if heating_state == 1:
-                m5mqtt.publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
+                mqtt_publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
                 heating_state = 0
             if fan_state == 1:
-                m5mqtt.publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_OFF)
+                mqtt_publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_OFF)
                 fan_state = 0
         elif action == "fan on":
-            m5mqtt.publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_ON)
-            m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "fan") 
+            mqtt_publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_ON)
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "fan") 
             fan_state = 1
             if heating_state == 1:
-                m5mqtt.publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
+                mqtt_publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
                 heating_state = 0
             if cooling_state == 1:
-                m5mqtt.publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
+                mqtt_publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
                 cooling_state = 0           
         elif action == "heating off":
-            m5mqtt.publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
-            m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
+            mqtt_publish(RELAY_HEAT_TOPIC, RELAY_HEAT_PAYLOAD_OFF)
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
             heating_state = 0
         elif action == "cooling off":
-            m5mqtt.publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
-            m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
+            mqtt_publish(RELAY_COOL_TOPIC, RELAY_COOL_PAYLOAD_OFF)
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
             cooling_state = 0
         elif action == "fan off":
-            m5mqtt.publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_OFF)
-            m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
+            mqtt_publish(RELAY_FAN_TOPIC, RELAY_FAN_PAYLOAD_OFF)
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_ACTION, "idle") 
             fan_state = 0           
+        stats_transitions(previous_states)
         delay = THERMO_MIN_CYCLE
         timerSch.run("delayed_start", 1000, 0x00)
-        timerSch.stop("blink_now")
         update_display()
     else:
         change_ignored = 1
+        # a deferred change is counted once, not at every decision until the min cycle is over
+        if action != blocked_action:
+            blocked_action = action
+            stats[action.split()[0]]["blocked"] += 1
         update_display()
 
+# Runtime accounting. Every transition updates a few counters, and the rolling hour/day windows are fixed rings of
+# buckets (a bucket is cleared when it is reused), so memory and work per transition are constant.
+# Runtime is accrued into the current bucket on every transition and every stats publish.
+def stats_window(buckets, bucket_length):
+    return {"length": bucket_length, "ids": [-1] * buckets, "starts": [0] * buckets, "runtime": [0] * buckets}
+
+def stats_init():
+    global stats, stats_started, blocked_action
+    stats = {}
+    blocked_action = None    # change deferred by the min cycle, counted as blocked once
+    stats_started = utime.time()
+    for appliance in STATS_APPLIANCES:
+        stats[appliance] = {
+            "on": False,
+            "on_since": 0,
+            "accrued": 0,
+            "runtime": 0,
+            "cycles": 0,
+            "shortest": None,
+            "longest": None,
+            "blocked": 0,
+            "hour": stats_window(STATS_HOUR_BUCKETS, 3600 // STATS_HOUR_BUCKETS),
+            "day": stats_window(STATS_DAY_BUCKETS, 86400 // STATS_DAY_BUCKETS)
+            }
+
+def stats_bucket(window, now):
+    bucket = now // window["length"]
+    index = bucket % len(window["ids"])
+    if window["ids"][index] != bucket:
+        window["ids"][index] = bucket
+        window["starts"][index] = 0
+        window["runtime"][index] = 0
+    return index
+
+def stats_window_sum(window, key, now):
+    oldest = now // window["length"] - len(window["ids"])
+    total = 0
+    for index in range(len(window["ids"])):
+        if window["ids"][index] > oldest:
+            total += window[key][index]
+    return total
+
+def stats_accrue(appliance, ticks_now, now):
+    entry = stats[appliance]
+    if entry["on"]:
+        seconds = utime.ticks_diff(ticks_now, entry["accrued"]) / 1000
+        entry["accrued"] = ticks_now
+        entry["runtime"] += seconds
+        for window in (entry["hour"], entry["day"]):
+            window["runtime"][stats_bucket(window, now)] += seconds
+
+def stats_transitions(previous_states):
+    ticks_now = utime.ticks_ms()
+    now = utime.time()
+    for appliance, was_on, is_on in zip(STATS_APPLIANCES, previous_states, (heating_state, cooling_state, fan_state)):
+        if was_on == is_on:
+            continue
+        entry = stats[appliance]
+        stats_accrue(appliance, ticks_now, now)
+        entry["on"] = is_on == 1
+        if entry["on"]:
+            entry["on_since"] = ticks_now
+            entry["accrued"] = ticks_now
+            entry["cycles"] += 1
+            for window in (entry["hour"], entry["day"]):
+                window["starts"][stats_bucket(window, now)] += 1
+        else:
+            length = utime.ticks_diff(ticks_now, entry["on_since"]) / 1000
+            entry["shortest"] = length if entry["shortest"] is None else min(entry["shortest"], length)
+            entry["longest"] = length if entry["longest"] is None else max(entry["longest"], length)
+
+def stats_payload():
+    ticks_now = utime.ticks_ms()
+    now = utime.time()
+    payload = {}
+    for appliance in STATS_APPLIANCES:
+        entry = stats[appliance]
+        stats_accrue(appliance, ticks_now, now)
+        payload[appliance + "_runtime"] = round(entry["runtime"] / 3600, 2)
+        payload[appliance + "_cycles"] = entry["cycles"]
+        payload[appliance + "_cycles_hour"] = stats_window_sum(entry["hour"], "starts", now)
+        payload[appliance + "_cycles_day"] = stats_window_sum(entry["day"], "starts", now)
+        payload[appliance + "_duty_day"] = round(100 * stats_window_sum(entry["day"], "runtime", now) /
+            max(1, min(86400, now - stats_started)), 1)
+        payload[appliance + "_shortest_cycle"] = None if entry["shortest"] is None else round(entry["shortest"])
+        payload[appliance + "_longest_cycle"] = None if entry["longest"] is None else round(entry["longest"])
+        payload[appliance + "_blocked"] = entry["blocked"]
+    payload["update_interval"] = update_interval
+    payload["touch_latency"] = None if touch_latency is None else round(touch_latency / 1000, 1)
+    payload["touch_latency_max"] = None if touch_latency_max is None else round(touch_latency_max / 1000, 1)
+    return payload
+
 
 def update_mqtt_state_topics():
     #update state of ENV sensors
     payload = {
-        "temperature": env20.temperature,
-        "humidity": env20.humidity,
-        "pressure": env20.pressure
+        "control_temperature": actual_temp,
+        "temperature": read_sensor("temperature"),
+        "humidity": read_sensor("humidity"),
+        "pressure": read_sensor("pressure")
         }
-    m5mqtt.publish(DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATE,str(json.dumps(payload)))
+    mqtt_publish(DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATE,str(json.dumps(payload)))
     
     #update state of thermostat target temperature
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATE, str(target_temp))
+    mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATE, str(target_temp))
     
     #update state of thermostat mode
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_STATE, str(thermo_state))    
+    mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_STATE, str(thermo_state))
+
+    #update runtime accounting
+    mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATS, str(json.dumps(stats_payload())))    
         
 @timerSch.event("delayed_start")
 def tdelayed_start():
-    global delay
+    global delay, blocked_action
+    trace_event("i", "timer", "delayed_start")
     delay -= 1
     if delay == 0:
         timerSch.stop("delayed_start")
+        blocked_action = None
         thermostat_decision_logic()
 
+# Not traced (one event per second): the loop step and snapshot events carry ticks instead
 @timerSch.event("main_loop")
 def tmain_loop():
     global ticks
     ticks += 1
             
-@timerSch.event("blink_now")
-def tblink_now():
-    global blink
-    if heating_state == 1:
-        color = DISP_COLOR_HEAT
-    elif cooling_state == 1:
-        color = DISP_COLOR_COOL
-    else:
-        color = 0xffffff
-    if blink == 0:
-        lbl_target.set_text_color(0x000000)
-        lbl_action.set_text_color(0x000000)
-        blink = 1
-    else:
-        lbl_target.set_text_color(color)
-        lbl_action.set_text_color(color)
-        blink = 0        
-
 def slider_target_changed(target_temp):
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATE, str(target_temp))
-    thermostat_decision_logic()
+    global touch_target_pending
+    started = utime.ticks_us()
+    trace_event("i", "touch", "slider", target_temp)
+    if thermo_state not in [THERMO_MODES[index] for index in [0,2]]:
+        lbl_target.set_text(str(round(target_temp if DISP_TEMPERATURE == "C" else target_temp * 9 / 5 + 32)))
+    touch_target_pending = True
+    touch_feedback(started)
 
 slider_target.changed(slider_target_changed)
 
@@ -787,7 +1282,7 @@ def rcv_target_temp (topic_data):
 def rcv_thermo_state (topic_data):
     global thermo_state
     thermo_state = str(topic_data) if str(topic_data) != "fan_only" else "fan"
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_STATE, str(thermo_state)) 
+    mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_STATE, str(thermo_state)) 
     thermostat_decision_logic()
 
 def rcv_heater_status (topic_data):
@@ -807,46 +1302,112 @@ def rcv_master_off (topic_data):
     thermo_state = THERMO_MODES[0]
     thermostat_decision_logic()
 
+def rcv_trace_dump (topic_data):
+    trace_dump()
+
+# Discovery requests are answered after a random delay (so a fleet doesn't answer all at once), at most
+# DISCOVERY_BUCKET_SIZE times in a burst (token bucket). Requests arriving while an answer is pending, or within
+# DISCOVERY_DEDUP_WINDOW of the last announce, are suppressed.
 def rcv_discovery (topic_data):
+    global discovery_tokens, discovery_refilled, discovery_pending, discovery_suppressed
+    # In seconds: ticks_ms() wraps around every 2^30 ms, and requests can be days apart
+    now = utime.time()
+    discovery_tokens = min(DISCOVERY_BUCKET_SIZE,
+        discovery_tokens + (now - discovery_refilled) / DISCOVERY_REFILL_TIME)
+    discovery_refilled = now
+    if (discovery_pending or discovery_tokens < 1 or now - discovery_announced < DISCOVERY_DEDUP_WINDOW):
+        discovery_suppressed += 1
+        return
+    discovery_tokens -= 1
+    discovery_pending = True
+    jitter_ms = random.randint(1, max(1, DISCOVERY_MAX_JITTER * 1000))
+    trace_event("i", "rand", "discovery", jitter_ms)
+    timerSch.run("discovery_announce", jitter_ms, 0x00)
+
+@timerSch.event("discovery_announce")
+def tdiscovery_announce():
+    global discovery_pending, discovery_announced
+    trace_event("i", "timer", "discovery_announce")
+    timerSch.stop("discovery_announce")
+    discovery_pending = False
+    discovery_announced = utime.time()
     mqtt_registration()
-    m5mqtt.publish(DEFAULT_TOPIC_SENSOR_PREFIX + TOPIC_STATUS, "on")
-    m5mqtt.publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATUS, "on")
-    m5mqtt.publish(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_HEATER_STATUS, "on")
-    m5mqtt.publish(DEFAULT_TOPIC_SWITCH_PREFIX + TOPIC_AC_STATUS, "on")
+    mqtt_availability()
     thermostat_decision_logic()
     
-thermostat_init()
-comms_init()
-thermostat_decision_logic()
-timerSch.run("main_loop", 999, 0x00)
+# One pass of the main loop. Returns True when it did some work (recorded in the trace so it can be replayed)
+def main_loop_step():
+    global manual_command, ticks, touch_mode_pending, touch_target_pending
+    worked = False
+    step_ticks = ticks
 
-while True:
-    
-# We ignore button presses unless the Thermostat is in manual mode
-    if btnA.wasPressed() and thermo_state == THERMO_MODES[2]:
-        if heating_state == 0:
-            manual_command = "heating on"
-        elif heating_state == 1:
-            manual_command = "heating off"
+# Work deferred by the touch callbacks. Several slider moves since the last pass are published once
+# Flags are cleared before publishing, so a touch arriving while mqtt_publish() blocks is kept for the next pass
+    if touch_mode_pending or touch_target_pending:
+        worked = True
+        mode_pending, target_pending = touch_mode_pending, touch_target_pending
+        touch_mode_pending = False
+        touch_target_pending = False
+        if mode_pending:
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_MODE_STATE, str(thermo_state))
+        if target_pending:
+            mqtt_publish(DEFAULT_TOPIC_THERMOSTAT_PREFIX + TOPIC_STATE, str(slider_target.get_value()))
         thermostat_decision_logic()
+
+    if ticks >= update_interval:
+        trace_snapshot()
+
+# We ignore button presses unless the Thermostat is in manual mode
+    if btnA.wasPressed():
+        trace_event("i", "btn", "A")
+        worked = True
+        if thermo_state == THERMO_MODES[2]:
+            if heating_state == 0:
+                manual_command = "heating on"
+            elif heating_state == 1:
+                manual_command = "heating off"
+            thermostat_decision_logic()
         
-    if btnB.wasPressed() and thermo_state == THERMO_MODES[2]:
-        if cooling_state == 0:
-            manual_command = "cooling on"
-        elif cooling_state == 1:
-            manual_command = "cooling off"
-        thermostat_decision_logic()
+    if btnB.wasPressed():
+        trace_event("i", "btn", "B")
+        worked = True
+        if thermo_state == THERMO_MODES[2]:
+            if cooling_state == 0:
+                manual_command = "cooling on"
+            elif cooling_state == 1:
+                manual_command = "cooling off"
+            thermostat_decision_logic()
         
-    if btnC.wasPressed() and thermo_state == THERMO_MODES[2]:
-        if fan_state == 0:
-            manual_command = "fan on"
-        elif fan_state == 1:
-            manual_command = "fan off"
-        thermostat_decision_logic()
+    if btnC.wasPressed():
+        trace_event("i", "btn", "C")
+        worked = True
+        if thermo_state == THERMO_MODES[2]:
+            if fan_state == 0:
+                manual_command = "fan on"
+            elif fan_state == 1:
+                manual_command = "fan off"
+            thermostat_decision_logic()
             
-    if ticks == THERMO_UPDATE_FREQUENCY:
+    if ticks >= update_interval:
+        worked = True
         thermostat_decision_logic()
+        update_trend()
+        update_cadence()
         update_mqtt_state_topics()
         ticks = 0
-    wait_ms(2)
-    
+    if worked:
+        trace_event("i", "loop", "step", step_ticks)
+    return worked
+
+def start():
+    trace_init()
+    thermostat_init()
+    comms_init()
+    thermostat_decision_logic()
+    timerSch.run("main_loop", 999, 0x00)
+
+if __name__ == "__main__":
+    start()
+    while True:
+        main_loop_step()
+        wait_ms(2)
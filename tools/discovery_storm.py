@@ -0,0 +1,86 @@
+# Discovery storm simulation.
+#
+# Runs a fleet of thermostats (each with its own MAC address) on one stand-in broker, lets Home Assistant send
+# discovery requests to the whole fleet (eg. after an HA restart, possibly repeated), and measures what the broker
+# receives: the peak inbound rate, the total number of messages, how many requests were suppressed and how long it
+# takes until every thermostat has re-announced itself.
+#
+# Usage:
+#   python tools/discovery_storm.py --devices 20 --requests 3 --interval 2
+#   python tools/discovery_storm.py --devices 20 --no-jitter      (every thermostat answers immediately)
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+
+BOOT_MS = 60000    # let the fleet boot and settle before Home Assistant sends its requests
+
+
+def run(args):
+    clock = standins.Clock()
+    broker = standins.Broker(clock)
+    devices = []
+    boot_rng = random.Random(args.seed)
+    boot_ms = sorted(boot_rng.randint(0, BOOT_MS // 2) for index in range(args.devices))
+    for index in range(args.devices):
+        device = standins.Device(clock, broker, path=args.thermostat, uid=b"\x24\x0a\xc4\x00" + bytes([index // 256, index % 256]))
+        device.mod.TRACE_ENABLED = False
+        device.mod.random = random.Random(args.seed + index)
+        if args.no_jitter:
+            device.mod.DISCOVERY_MAX_JITTER = 0
+            device.mod.DISCOVERY_DEDUP_WINDOW = 0
+            device.mod.DISCOVERY_BUCKET_SIZE = args.requests
+        # Thermostats boot at different times, so their periodic updates aren't aligned
+        if devices:
+            standins.run_until(devices, boot_ms[index])
+        clock.ms = boot_ms[index]
+        device.start()
+        devices.append(device)
+    standins.run_until(devices, BOOT_MS)
+
+    topic = devices[0].mod.DEFAULT_TOPIC_FLEET_DISCOVERY
+    del broker.log[:]
+    for request in range(args.requests):
+        standins.run_until(devices, BOOT_MS + int(request * args.interval * 1000))
+        broker.inject(topic, "")
+    end_ms = BOOT_MS + int((args.requests * args.interval + 2 * devices[0].mod.DISCOVERY_MAX_JITTER + 5) * 1000)
+    standins.run_until(devices, end_ms)
+
+    config_ms = [ms for ms, sender, t, payload in broker.log if sender is not None and t.endswith("/config")]
+    uids = set(device.mod.DEVICE_ID for device in devices)
+    return {
+        "devices": args.devices,
+        "requests": args.requests,
+        "unique_ids": len(uids),
+        "messages": len([entry for entry in broker.log if entry[1] is not None]),
+        "config_messages": len(config_ms),
+        "peak_per_s": broker.inbound_rate(1000),
+        "peak_per_100ms": broker.inbound_rate(100),
+        "suppressed": sum(device.mod.discovery_suppressed for device in devices),
+        "announce_span_s": (max(config_ms) - min(config_ms)) / 1000.0 if config_ms else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate Home Assistant discovery requests to a thermostat fleet")
+    parser.add_argument("--thermostat", default=standins.THERMOSTAT_PATH, help="path to Thermostat.py")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=3, help="discovery requests sent by Home Assistant")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between requests")
+    parser.add_argument("--no-jitter", action="store_true", help="answer every request immediately (no rate limiting)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    report = run(args)
+    for key in ["devices", "requests", "unique_ids", "messages", "config_messages", "suppressed", "peak_per_s",
+                "peak_per_100ms", "announce_span_s"]:
+        print("%-16s %s" % (key, report[key]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
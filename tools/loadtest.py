@@ -0,0 +1,258 @@
+# Command-to-relay latency load test.
+#
+# Drives the inbound Home Assistant topics (temperature/command, mode/command, heater/command, ac/command) at
+# configurable rates through the stand-in broker, and measures how the thermostat keeps up:
+# - latency from each command to the relay publish, and to the 'action' topic update (p50/p99)
+# - what happened to each command: applied right away, applied once the min-cycle delay expired, superseded by a
+#   later command (or no longer needed when the delay expired), ignored (no change needed) or dropped because the
+#   inbound queue was full
+# - inbound queue growth
+#
+# The Core2 handles one thing at a time, so the thermostat is modelled as a single server: every MQTT message or
+# timer firing occupies it for --service-ms plus --publish-ms per publish it makes. Messages arriving meanwhile
+# wait in the inbound queue. Everything runs in virtual time, so results are repeatable for a given --seed.
+#
+# Usage:
+#   python tools/loadtest.py --scenario mixed --duration 600 --out report.json [--compare previous.json]
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+
+# Commands per second for each inbound topic
+SCENARIOS = {
+    "target-spam": {"target": 5.0, "mode": 0.0, "heater": 0.0, "ac": 0.0},
+    "mode-flap": {"target": 0.0, "mode": 2.0, "heater": 0.0, "ac": 0.0},
+    "toggle-storm": {"target": 0.0, "mode": 0.0, "heater": 3.0, "ac": 3.0},
+    "mixed": {"target": 1.0, "mode": 0.5, "heater": 0.5, "ac": 0.5},
+}
+
+
+# Outcome of each command sent ("sent" is the sum of the others)
+COUNTS = ["sent", "applied", "applied_after_delay", "superseded", "ignored", "dropped"]
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def command_schedule(mod, rates, duration_ms, rng):
+    thermostat = mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX
+    switch = mod.DEFAULT_TOPIC_SWITCH_PREFIX
+    sources = {
+        "target": (thermostat + mod.TOPIC_TEMPERATURE_COMMAND,
+                   lambda: str(rng.randint(mod.THERMO_MIN_TARGET, mod.THERMO_MAX_TARGET))),
+        "mode": (thermostat + mod.TOPIC_MODE_COMMAND, lambda: rng.choice(["auto", "heat", "cool", "fan_only", "off"])),
+        "heater": (switch + mod.TOPIC_HEATER_COMMAND,
+                   lambda: rng.choice([mod.RELAY_HEAT_PAYLOAD_ON, mod.RELAY_HEAT_PAYLOAD_OFF])),
+        "ac": (switch + mod.TOPIC_AC_COMMAND, lambda: rng.choice([mod.RELAY_COOL_PAYLOAD_ON, mod.RELAY_COOL_PAYLOAD_OFF])),
+    }
+    schedule = []
+    for name, rate in sorted(rates.items()):
+        if rate <= 0:
+            continue
+        topic, payload = sources[name]
+        t = rng.expovariate(rate) * 1000
+        while t < duration_ms:
+            schedule.append((int(t), name, topic, payload()))
+            t += rng.expovariate(rate) * 1000
+    schedule.sort()
+    return schedule
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    device = standins.Device(path=args.thermostat)
+    mod = device.mod
+    mod.TRACE_ENABLED = False
+    if args.min_cycle is not None:
+        mod.THERMO_MIN_CYCLE = args.min_cycle
+    device.sensor.values["temperature"] = args.temperature
+    device.start()
+    device.mqtt.callbacks[mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX + mod.TOPIC_MODE_COMMAND](args.mode)
+
+    rates = dict(SCENARIOS[args.scenario])
+    for name in rates:
+        if getattr(args, "rate_" + name) is not None:
+            rates[name] = getattr(args, "rate_" + name)
+    duration_ms = int(args.duration * 1000)
+    schedule = command_schedule(mod, rates, duration_ms, rng)
+
+    relay_topics = (mod.RELAY_HEAT_TOPIC, mod.RELAY_COOL_TOPIC, mod.RELAY_FAN_TOPIC)
+    action_topic = mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX + mod.TOPIC_ACTION
+    clock, inbox = device.clock, device.mqtt.inbox
+    counts = dict((key, 0) for key in COUNTS)
+    relay_latency, action_latency, queue_wait = [], [], []
+    pending = []          # send times of the commands deferred by the min-cycle delay
+    queue_samples = []    # (second, queue depth)
+    max_queue = 0
+    busy_until = 0
+    next_command = 0
+
+    # Changes deferred by the min-cycle delay, counted per call: change_ignored stays set until a change is applied,
+    # and the blocked stats count a deferred change only once
+    deferred = [0]
+    change_to = mod.change_to
+
+    def counting_change_to(action):
+        change_to(action)
+        if mod.change_ignored == 1:
+            deferred[0] += 1
+    mod.change_to = counting_change_to
+
+    def serve(work):
+        # Run one unit of work on the thermostat and return the time it finishes, what it published and whether
+        # it wanted a change the min-cycle delay deferred
+        published = len(device.mqtt.published)
+        deferred_before = deferred[0]
+        work()
+        mod.main_loop_step()
+        outputs = [topic for ms, topic, payload in device.mqtt.published[published:]]
+        # whole ms, like utime.ticks_ms()
+        done_ms = int(math.ceil(clock.ms + args.service_ms + args.publish_ms * len(outputs)))
+        return done_ms, outputs, deferred[0] > deferred_before
+
+    def resolve(done_ms, outputs, sent_ms):
+        relay = any(topic in relay_topics for topic in outputs)
+        if relay:
+            relay_latency.append(done_ms - sent_ms)
+        if action_topic in outputs:
+            action_latency.append(done_ms - sent_ms)
+        return relay
+
+    while clock.ms < duration_ms or inbox:
+        arrival = schedule[next_command][0] if next_command < len(schedule) else None
+        timer = device.timers.next_due()
+        service = max(clock.ms, busy_until) if inbox else None
+        candidates = [t for t in (arrival, timer, service) if t is not None]
+        if not candidates:
+            break
+        now = min(candidates)
+        while len(queue_samples) <= now // 1000 and len(queue_samples) <= duration_ms // 1000:
+            queue_samples.append((len(queue_samples), len(inbox)))
+        clock.ms = max(clock.ms, now)
+
+        if arrival is not None and arrival <= now:
+            ms, name, topic, payload = schedule[next_command]
+            next_command += 1
+            counts["sent"] += 1
+            if args.queue_limit and len(inbox) >= args.queue_limit:
+                counts["dropped"] += 1
+                continue
+            device.broker.inject(topic, payload)
+            max_queue = max(max_queue, len(inbox))
+        elif clock.ms < busy_until:
+            clock.ms = busy_until
+        elif inbox and (timer is None or service <= timer):
+            topic, payload, sent_ms = inbox[0]
+            queue_wait.append(clock.ms - sent_ms)
+            done_ms, outputs, blocked = serve(device.mqtt.deliver_one)
+            busy_until = done_ms
+            if resolve(done_ms, outputs, sent_ms):
+                counts["applied"] += 1
+                counts["superseded"] += len(pending)
+                pending = []
+            elif blocked and mod.delay > 0:
+                counts["superseded"] += len(pending)
+                pending = [sent_ms]
+            else:
+                counts["ignored"] += 1
+        else:
+            done_ms, outputs, blocked = serve(device.timers.fire_due)
+            busy_until = done_ms
+            if pending and any(topic in relay_topics for topic in outputs):
+                for sent_ms in pending:
+                    resolve(done_ms, outputs, sent_ms)
+                counts["applied_after_delay"] += len(pending)
+                pending = []
+            elif pending and mod.delay <= 0:
+                # The min-cycle delay expired and the deferred change is no longer needed
+                counts["superseded"] += len(pending)
+                pending = []
+    counts["superseded"] += len(pending)
+
+    with open(args.thermostat, "rb") as f:
+        thermostat_hash = hashlib.sha256(f.read()).hexdigest()[:12]
+    seconds = [depth for second, depth in queue_samples]
+    half = len(seconds) // 2
+    return {
+        "thermostat": thermostat_hash,
+        "scenario": args.scenario,
+        "rates": rates,
+        "duration_s": args.duration,
+        "seed": args.seed,
+        "service_ms": args.service_ms,
+        "publish_ms": args.publish_ms,
+        "min_cycle_s": mod.THERMO_MIN_CYCLE,
+        "commands": counts,
+        "relay_latency_ms": {"p50": percentile(relay_latency, 50), "p99": percentile(relay_latency, 99),
+                             "max": max(relay_latency) if relay_latency else None, "count": len(relay_latency)},
+        "action_latency_ms": {"p50": percentile(action_latency, 50), "p99": percentile(action_latency, 99),
+                              "max": max(action_latency) if action_latency else None, "count": len(action_latency)},
+        "queue_wait_ms": {"p50": percentile(queue_wait, 50), "p99": percentile(queue_wait, 99)},
+        "queue": {"max": max_queue, "final": seconds[-1] if seconds else 0,
+                  # average depth in the second half minus the first half: > 0 means the queue keeps growing
+                  "growth": (sum(seconds[half:]) / max(1, len(seconds) - half)) - (sum(seconds[:half]) / max(1, half))},
+    }
+
+
+def print_report(report, previous=None):
+    print("scenario %s, %gs, rates %s (thermostat %s)" % (
+        report["scenario"], report["duration_s"],
+        ", ".join("%s=%g/s" % item for item in sorted(report["rates"].items())), report["thermostat"]))
+    print("commands: " + ", ".join("%s %d" % (key, report["commands"][key]) for key in COUNTS))
+    rows = [("relay_latency_ms", "p50"), ("relay_latency_ms", "p99"), ("action_latency_ms", "p50"),
+            ("action_latency_ms", "p99"), ("queue_wait_ms", "p50"), ("queue_wait_ms", "p99"), ("queue", "max"),
+            ("queue", "growth")]
+    for section, key in rows:
+        value = report[section][key]
+        line = "%-18s %-6s %s" % (section, key, "-" if value is None else "%g" % value)
+        if previous is not None and previous.get(section, {}).get(key) is not None and value is not None:
+            line += "   (was %g, %+g)" % (previous[section][key], value - previous[section][key])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command-to-relay latency load test")
+    parser.add_argument("--thermostat", default=standins.THERMOSTAT_PATH, help="path to Thermostat.py")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--rate-target", type=float, help="temperature/command messages per second")
+    parser.add_argument("--rate-mode", type=float, help="mode/command messages per second")
+    parser.add_argument("--rate-heater", type=float, help="heater/command messages per second")
+    parser.add_argument("--rate-ac", type=float, help="ac/command messages per second")
+    parser.add_argument("--duration", type=float, default=600, help="seconds of virtual time")
+    parser.add_argument("--service-ms", type=float, default=20, help="time the Core2 spends per message or timer")
+    parser.add_argument("--publish-ms", type=float, default=5, help="time the Core2 spends per publish")
+    parser.add_argument("--queue-limit", type=int, default=0, help="inbound queue size (0 = unbounded)")
+    parser.add_argument("--min-cycle", type=int, help="override THERMO_MIN_CYCLE (seconds)")
+    parser.add_argument("--temperature", type=float, default=19.0, help="room temperature reported by the ENVII")
+    parser.add_argument("--mode", default="auto", help="thermostat mode at the start of the test")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="write the report as JSON")
+    parser.add_argument("--compare", help="previous JSON report to compare with")
+    args = parser.parse_args()
+
+    report = run(args)
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    print_report(report, previous)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+# Deterministic replay of thermostat traces.
+#
+# A trace is a list of [ticks_ms, direction, kind, key, value] events written by the trace recorder in
+# Thermostat.py (one JSON array per line). The replayer loads Thermostat.py on stand-in modules, feeds the
+# recorded inputs back through the thermostat logic as fast as possible, and diffs the MQTT outputs it produces
+# (relays, action, state and discovery topics) against the recorded ones.
+#
+# A trace either starts at boot (host recordings, or a RAM buffer dumped before it wrapped around), or is replayed
+# from its first state snapshot (RAM buffer dumps from a unit that has been running for a while).
+# Later snapshots are used as checkpoints: the replayed state is compared with the recorded one.
+# Snapshots carry the sensor fusion state (readings, their age and room occupancy), but not the runtime accounting,
+# so the stats topic isn't compared when replaying from a snapshot.
+#
+# Usage:
+#   python tools/replay.py replay trace.log
+#   python tools/replay.py record trace.log --hours 2     (host recording of a simulated session)
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+
+SNAPSHOT_KEYS = ["thermo_state", "target_temp", "heating_state", "cooling_state", "fan_state", "manual_command",
+                 "change_ignored", "delay", "ticks", "update_interval", "temp_trend", "trend_temp", "trend_ms", "sensors",
+                 "occupied", "sensor_sum", "sensor_weight", "occupied_sum", "occupied_weight"]
+# Snapshot keys that aren't plain module globals
+DERIVED_KEYS = ["target_temp", "sensors", "occupied"]
+
+
+def load_trace(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    return events
+
+
+def device_state(mod):
+    state = dict((key, getattr(mod, key)) for key in SNAPSHOT_KEYS if key not in DERIVED_KEYS)
+    state["target_temp"] = mod.slider_target.get_value()
+    state["sensors"] = mod.sensors_snapshot()
+    state["occupied"] = dict(mod.sensor_occupied)
+    return state
+
+
+def restore_state(mod, state):
+    # Rebuild the sensor fusion state, oldest reading first so the expiry order is the recorded one. The running
+    # sums are then set to the recorded ones (rebuilt sums can differ in the last bits)
+    mod.sensors_init()
+    for name, occupied in state["occupied"].items():
+        mod.sensor_set_occupied(name, occupied)
+    now = mod.utime.ticks_ms()
+    for name, (value, age) in sorted(state["sensors"].items(), key=lambda item: -(item[1][1] or 0)):
+        mod.sensor_update(name, value)
+        if age is not None:
+            mod.sensor_stamps[name] = mod.utime.ticks_add(now, -age)
+    for key in SNAPSHOT_KEYS:
+        if key not in DERIVED_KEYS:
+            setattr(mod, key, state[key])
+    mod.slider_target.set_value(state["target_temp"])
+    mod.target_temp = state["target_temp"]
+    mod.actual_temp = state["actual_temp"]
+    for appliance, key in zip(mod.STATS_APPLIANCES, ["heating_state", "cooling_state", "fan_state"]):
+        entry = mod.stats[appliance]
+        entry["on"] = state[key] == 1
+        entry["on_since"] = entry["accrued"] = mod.utime.ticks_ms()
+
+
+def find_start(events):
+    if events and events[0][2] == "boot":
+        return 0
+    for index, event in enumerate(events):
+        if event[2] == "snapshot":
+            return index
+    raise ValueError("trace neither starts at boot nor contains a state snapshot")
+
+
+def dispatch(device, event):
+    mod = device.mod
+    ms, direction, kind, key, value = event
+    if kind == "mqtt":
+        device.mqtt.callbacks[key](value)
+    elif kind == "timer" and key in device.timers.handlers:
+        device.timers.handlers[key]()
+    elif kind == "btn":
+        device.buttons[key].press()
+    elif kind == "loop":
+        # the main loop timer isn't traced, ticks is recorded with the step instead
+        if value is not None:
+            mod.ticks = value
+        mod.main_loop_step()
+    elif kind == "touch" and key == "mode":
+        mod.change_mode(mod.btn, mod.lv.EVENT.CLICKED)
+    elif kind == "touch" and key == "slider":
+        mod.slider_target.set_value(value)
+        mod.slider_target_changed(value)
+    elif kind == "touch" and key == "latency":
+        mod.touch_latency_record(value)
+
+
+def replay(events, path=standins.THERMOSTAT_PATH):
+    start = find_start(events)
+    device = standins.Device(path=path)
+    mod = device.mod
+    mod.TRACE_ENABLED = False
+    device.clock.ms = events[start][0]
+    if events[start][2] == "snapshot":
+        # Boot on the recorded state, then drop what the boot sequence published
+        device.sensor.values["temperature"] = events[start][4]["actual_temp"]
+        device.start()
+        restore_state(mod, events[start][4])
+        del device.mqtt.published[:]
+
+    for ms, direction, kind, key, value in events[start:]:
+        if direction == "i" and kind == "sensor":
+            device.sensor.queue(key, value)
+    mod.random = standins.RecordedRandom(e[4] for e in events[start:] if e[1] == "i" and e[2] == "rand")
+
+    checkpoints = []
+    for event in events[start:]:
+        device.clock.ms = event[0]
+        if event[2] == "boot":
+            device.start()
+        elif event[2] == "snapshot" and event is not events[start]:
+            # snapshots are taken within a loop step, before its event restores ticks
+            mod.ticks = event[4]["ticks"]
+            replayed = device_state(mod)
+            recorded = dict((key, event[4][key]) for key in SNAPSHOT_KEYS)
+            if replayed != recorded:
+                checkpoints.append((event[0], recorded, replayed))
+        elif event[1] == "i":
+            dispatch(device, event)
+
+    skipped = [mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX + mod.TOPIC_STATS] if events[start][2] == "snapshot" else []
+    expected = [(e[3], e[4]) for e in events[start:] if e[1] == "o" and e[3] not in skipped]
+    produced = [(topic, payload) for ms, topic, payload in device.mqtt.published if topic not in skipped]
+    return expected, produced, checkpoints
+
+
+def diff_outputs(expected, produced):
+    for index in range(min(len(expected), len(produced))):
+        if expected[index] != produced[index]:
+            return index
+    if len(expected) != len(produced):
+        return min(len(expected), len(produced))
+    return None
+
+
+def cmd_replay(args):
+    events = load_trace(args.trace)
+    started = time.perf_counter()
+    expected, produced, checkpoints = replay(events, args.thermostat)
+    elapsed = time.perf_counter() - started
+    print("%d events replayed in %.3f s (%.0f events/s)" % (len(events), elapsed, len(events) / max(elapsed, 1e-9)))
+    print("outputs: %d recorded, %d replayed" % (len(expected), len(produced)))
+
+    ok = True
+    index = diff_outputs(expected, produced)
+    if index is not None:
+        ok = False
+        print("first divergence at output #%d" % index)
+        print("  recorded: %s" % (expected[index] if index < len(expected) else "<none>",))
+        print("  replayed: %s" % (produced[index] if index < len(produced) else "<none>",))
+    for ms, recorded, replayed in checkpoints:
+        ok = False
+        changed = ", ".join("%s %r != %r" % (key, recorded[key], replayed[key])
+                            for key in SNAPSHOT_KEYS if recorded[key] != replayed[key])
+        print("state mismatch at %d ms: %s" % (ms, changed))
+    print("OK" if ok else "DIVERGED")
+    return 0 if ok else 1
+
+
+# Host recording: a simulated session with a slowly swinging room temperature and a few Home Assistant commands
+def cmd_record(args):
+    if os.path.exists(args.trace):
+        os.remove(args.trace)
+    device = standins.Device(path=args.thermostat)
+    device.mod.TRACE_FILE = args.trace
+    device.sensor.provider = lambda name, value: (
+        20 + 3 * math.sin(device.clock.ms / 1800000.0) if name == "temperature" else value)
+    device.start()
+    prefix = device.mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX
+    commands = [(60, prefix + "mode/command", "auto"), (600, prefix + "temperature/command", "21"),
+                (1800, prefix + "mode/command", "heat"), (2400, device.mod.DEFAULT_TOPIC_SWITCH_PREFIX + "ac/command", "ON"),
+                (2410, prefix + "mode/command", "auto"), (3000, prefix + "discovery", ""),
+                (3002, prefix + "discovery", "")]
+    for seconds, topic, payload in commands:
+        standins.run_until([device], seconds * 1000)
+        device.broker.inject(topic, payload)
+    device.buttons["A"].press()
+    standins.run_until([device], args.hours * 3600 * 1000)
+    device.mod.trace_file.close()
+    print("recorded %s" % args.trace)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay thermostat traces")
+    parser.add_argument("--thermostat", default=standins.THERMOSTAT_PATH, help="path to Thermostat.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    replay_parser = commands.add_parser("replay", help="replay a trace and diff the outputs")
+    replay_parser.add_argument("trace")
+    replay_parser.set_defaults(func=cmd_replay)
+    record_parser = commands.add_parser("record", help="record a simulated session")
+    record_parser.add_argument("trace")
+    record_parser.add_argument("--hours", type=float, default=1)
+    record_parser.set_defaults(func=cmd_record)
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+# Stand-in modules to run Thermostat.py on a host (replays, load tests and simulations).
+#
+# Thermostat.py is loaded unmodified: the UIFlow/M5Stack modules it imports (m5stack, m5stack_ui, uiflow, wifiCfg,
+# m5mqtt, unit, lvgl, config, utime, machine, ubinascii) are replaced by the small stand-ins below, all driven by a virtual clock.
+# Nothing here sleeps, so a day of thermostat activity runs in a fraction of a second.
+#
+# - Clock: virtual time in ms, shared by all stand-ins (utime.ticks_ms, utime.time)
+# - Broker: in-process MQTT broker that routes messages between clients and logs all traffic
+# - Device: one thermostat instance (module + its timers, sensor, buttons and MQTT client)
+# - run_until: advances a set of devices sharing a clock and a broker, firing timers and delivering messages
+
+import binascii
+import collections
+import os
+import sys
+import types
+
+THERMOSTAT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Thermostat.py")
+
+
+# Like MicroPython on the ESP32, ticks wrap around every TICKS_PERIOD (about 12.4 days of ms) and ticks_diff() is
+# only valid for differences of less than half of that
+TICKS_PERIOD = 1 << 30
+
+
+class Clock:
+    def __init__(self, ms=0):
+        self.ms = ms
+
+    def ticks_ms(self):
+        return self.ms % TICKS_PERIOD
+
+    def ticks_us(self):
+        return self.ms * 1000 % TICKS_PERIOD
+
+    def ticks_diff(self, new, old):
+        return (new - old + TICKS_PERIOD // 2) % TICKS_PERIOD - TICKS_PERIOD // 2
+
+    def ticks_add(self, ticks, delta):
+        return (ticks + delta) % TICKS_PERIOD
+
+    def time(self):
+        return self.ms // 1000
+
+
+# Absorbs any attribute access or call. Used for the display side (LVGL objects, images, lcd, screen).
+# Attributes are cached, so constants like lv.EVENT.CLICKED compare equal to themselves.
+class Anything:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        value = Anything()
+        object.__setattr__(self, name, value)
+        return value
+
+    def __call__(self, *args, **kwargs):
+        return Anything()
+
+
+class Label(Anything):
+    def __init__(self, text="", x=0, y=0, color=0, font=None, parent=None):
+        self.text = text
+        self.color = color
+        self.hidden = False
+
+    def set_text(self, text):
+        self.text = text
+
+    def get_text(self):
+        return self.text
+
+    def set_text_color(self, color):
+        self.color = color
+
+    def set_hidden(self, hidden):
+        self.hidden = hidden
+
+
+class Slider(Anything):
+    def __init__(self, x=0, y=0, w=0, h=0, min=0, max=100, bg_c=0, color=0, parent=None):
+        self.min = min
+        self.max = max
+        self.value = min
+        self.hidden = False
+        self.callback = None
+
+    def set_range(self, min, max):
+        self.min = min
+        self.max = max
+
+    def set_value(self, value):
+        self.value = value
+
+    def get_value(self):
+        return self.value
+
+    def set_hidden(self, hidden):
+        self.hidden = hidden
+
+    def changed(self, callback):
+        self.callback = callback
+
+
+# random module serving values recorded in a trace (falls back to the low bound once they run out)
+class RecordedRandom:
+    def __init__(self, values=()):
+        self.values = collections.deque(values)
+
+    def randint(self, low, high):
+        return self.values.popleft() if self.values else low
+
+
+class Button:
+    def __init__(self):
+        self.pressed = False
+
+    def press(self):
+        self.pressed = True
+
+    def wasPressed(self):
+        pressed, self.pressed = self.pressed, False
+        return pressed
+
+
+# ENVII sensor. Readings come from queued values (replays), from a provider function (simulations),
+# or stay at their last value.
+class EnvSensor:
+    def __init__(self, temperature=20.0, humidity=40.0, pressure=1013.0):
+        self.values = {"temperature": temperature, "humidity": humidity, "pressure": pressure}
+        self.queues = collections.defaultdict(collections.deque)
+        self.provider = None
+
+    def queue(self, name, value):
+        self.queues[name].append(value)
+
+    def read(self, name):
+        if self.queues[name]:
+            self.values[name] = self.queues[name].popleft()
+        elif self.provider is not None:
+            self.values[name] = self.provider(name, self.values[name])
+        return self.values[name]
+
+    temperature = property(lambda self: self.read("temperature"))
+    humidity = property(lambda self: self.read("humidity"))
+    pressure = property(lambda self: self.read("pressure"))
+
+
+# uiflow.timerSch: named periodic timers driven by the virtual clock
+class Scheduler:
+    def __init__(self, clock):
+        self.clock = clock
+        self.handlers = {}
+        self.running = {}    # name -> [period_ms, next_due_ms]
+
+    def event(self, name):
+        def register(handler):
+            self.handlers[name] = handler
+            return handler
+        return register
+
+    def run(self, name, period, mode=0):
+        if name not in self.running:
+            self.running[name] = [period, self.clock.ms + period]
+
+    def stop(self, name):
+        self.running.pop(name, None)
+
+    def next_due(self):
+        if not self.running:
+            return None
+        return min(due for period, due in self.running.values())
+
+    def fire_due(self):
+        fired = 0
+        for name in sorted(self.running, key=lambda n: self.running[n][1]):
+            timer = self.running.get(name)
+            if timer is not None and timer[1] <= self.clock.ms:
+                timer[1] += timer[0]
+                self.handlers[name]()
+                fired += 1
+        return fired
+
+
+def decode(payload):
+    return payload if isinstance(payload, str) else payload.decode("utf-8")
+
+
+# In-process MQTT broker. Messages are queued in the inbox of every subscribed client and delivered by run_until,
+# so a handler never runs inside another client's publish. `log` keeps (ms, client_id, topic, payload) of all
+# traffic the broker received.
+class Broker:
+    def __init__(self, clock):
+        self.clock = clock
+        self.clients = []
+        self.log = []
+
+    def publish(self, sender, topic, payload):
+        payload = decode(payload)
+        self.log.append((self.clock.ms, sender.client_id if sender else None, topic, payload))
+        for client in self.clients:
+            if client is not sender and topic in client.callbacks:
+                client.inbox.append((topic, payload, self.clock.ms))
+
+    # Publish from outside the thermostats (Home Assistant, automations, remote sensors)
+    def inject(self, topic, payload):
+        self.publish(None, topic, payload)
+
+    # Peak number of messages the broker received from the thermostats within any window of window_ms
+    def inbound_rate(self, window_ms=1000):
+        times = [ms for ms, sender, topic, payload in self.log if sender is not None]
+        peak, first = 0, 0
+        for last in range(len(times)):
+            while times[last] - times[first] >= window_ms:
+                first += 1
+            peak = max(peak, last - first + 1)
+        return peak
+
+
+class MqttClient:
+    def __init__(self, broker, client_id):
+        self.broker = broker
+        self.client_id = client_id
+        self.callbacks = {}
+        self.inbox = collections.deque()
+        self.published = []
+        broker.clients.append(self)
+
+    def subscribe(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def start(self):
+        pass
+
+    def publish(self, topic, payload):
+        self.published.append((self.broker.clock.ms, topic, decode(payload)))
+        self.broker.publish(self, topic, payload)
+
+    def deliver_one(self):
+        topic, payload, sent_ms = self.inbox.popleft()
+        self.callbacks[topic](payload)
+        return topic, payload, sent_ms
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+
+def load_module(path, modules, name="thermostat"):
+    saved = dict((key, sys.modules.get(key)) for key in modules)
+    sys.modules.update(modules)
+    try:
+        module = types.ModuleType(name)
+        module.__file__ = path
+        with open(path) as f:
+            code = compile(f.read(), path, "exec")
+        exec(code, module.__dict__)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                sys.modules.pop(key, None)
+            else:
+                sys.modules[key] = value
+    return module
+
+
+# One thermostat running on stand-in modules. Devices created with the same clock and broker share them.
+class Device:
+    def __init__(self, clock=None, broker=None, path=THERMOSTAT_PATH, uid=b"\x24\x0a\xc4\x00\x00\x01"):
+        self.clock = clock or Clock()
+        self.broker = broker or Broker(self.clock)
+        self.timers = Scheduler(self.clock)
+        self.sensor = EnvSensor()
+        self.buttons = {"A": Button(), "B": Button(), "C": Button()}
+        self.mqtt = None
+
+        def make_client(client, server, port, user, password, keepalive):
+            self.mqtt = MqttClient(self.broker, client)
+            return self.mqtt
+
+        modules = {
+            "m5stack": _module("m5stack", lcd=Anything(), btnA=self.buttons["A"], btnB=self.buttons["B"],
+                               btnC=self.buttons["C"]),
+            "m5stack_ui": _module("m5stack_ui", M5Screen=Anything, M5Img=Anything, M5Label=Label, M5Slider=Slider,
+                                  FONT_MONT_12=12, FONT_MONT_40=40, ALIGN_CENTER=9),
+            "uiflow": _module("uiflow", timerSch=self.timers, wait_ms=lambda ms: None),
+            "wifiCfg": _module("wifiCfg", doConnect=lambda ssid, password: None),
+            "m5mqtt": _module("m5mqtt", M5mqtt=make_client),
+            "unit": _module("unit", ENV2="ENV2", PORTA="PORTA", get=lambda kind, port: self.sensor),
+            "lvgl": Anything(),
+            "config": _module("config", MQTT_IP="127.0.0.1", MQTT_PORT=1883, MQTT_USER="", MQTT_PASS="",
+                              WIFI_SSID="", WIFI_PASS=""),
+            "utime": _module("utime", ticks_ms=self.clock.ticks_ms, ticks_us=self.clock.ticks_us,
+                             ticks_diff=self.clock.ticks_diff, ticks_add=self.clock.ticks_add, time=self.clock.time),
+            "machine": _module("machine", unique_id=lambda: uid),
+            "ubinascii": binascii,
+        }
+        self.mod = load_module(path, modules)
+
+    def start(self):
+        self.mod.start()
+
+    def next_event_ms(self):
+        if self.mqtt is not None and self.mqtt.inbox:
+            return self.clock.ms
+        return self.timers.next_due()
+
+    # Deliver pending MQTT messages and fire due timers, running a main loop pass after each of them
+    # (on the Core2 the main loop runs every 2 ms)
+    def run_pending(self):
+        while self.mqtt is not None and self.mqtt.inbox:
+            self.mqtt.deliver_one()
+            self.mod.main_loop_step()
+        if self.timers.fire_due():
+            self.mod.main_loop_step()
+
+
+def run_until(devices, until_ms):
+    clock = devices[0].clock
+    while True:
+        due = [d.next_event_ms() for d in devices]
+        due = [t for t in due if t is not None]
+        if not due or min(due) > until_ms:
+            clock.ms = max(clock.ms, until_ms)
+            return
+        clock.ms = max(clock.ms, min(due))
+        for device in devices:
+            device.run_pending()
@@ -0,0 +1,555 @@
+# Offline tuning of THERMO_COLD_TOLERANCE, THERMO_HEAT_TOLERANCE, THERMO_MIN_CYCLE and THERMO_UPDATE_FREQUENCY.
+#
+# A NumPy re-implementation of thermostat_decision_logic()/change_to() evaluates every parameter combination of a
+# grid in parallel (one array element per combination) against outdoor temperature traces, through a simple
+# thermal model of the house (Newton cooling towards the outdoor temperature, plus a fixed heating/cooling rate
+# while the furnace/AC/fan is on). For each combination it reports comfort error, cycles and runtime.
+#
+# Same semantics as the Core2:
+# - the main loop ticks every second, a decision is made when ticks reaches the update interval (ticks reset)
+# - with THERMO_ADAPTIVE_UPDATE (the default, read from Thermostat.py), the update interval is recomputed by
+#   update_cadence() at every decision and the temperature trend by update_trend() after every periodic decision;
+#   --fixed-cadence evaluates THERMO_ADAPTIVE_UPDATE = False (a decision every THERMO_UPDATE_FREQUENCY seconds)
+# - after every change, further changes are ignored until the min cycle delay has counted down to 0, at which
+#   point a decision is made right away (before the main loop decision of that second)
+#
+# The engine is event driven: each combination jumps straight to its next decision, min cycle expiry or weather
+# value, so a year costs one iteration per decision of the busiest combination rather than one per second.
+# Outdoor temperatures are held for --weather-step seconds and the inside temperature between two events is the
+# exact solution of the thermal model (exponential approach to the equilibrium of the running appliances).
+# Comfort metrics are integrated analytically over the same segments. Near a threshold the adaptive cadence
+# decides every THERMO_MIN_UPDATE_FREQUENCY seconds, so each combination costs several times more than with
+# --fixed-cadence. THERMO_UPDATE_FREQUENCY barely matters then, and is only swept with --fixed-cadence or when
+# --update-frequency is given.
+#
+# --check runs a few combinations through Thermostat.py itself (stand-in modules, same thermal model) and
+# verifies the relay changes and blocked change counts match the vectorized engine. The Core2 main loop timer runs
+# every 999 ms; both the engine and the check use 1000 ms.
+#
+# Usage:
+#   python tools/sweep.py --days 365 --out sweep.csv
+#   python tools/sweep.py --weather outdoor.csv --weather-step 3600 --cold-tolerance 0.25,0.5,1 --min-cycle 300,600
+#   python tools/sweep.py --check 5 --check-days 2
+#   python tools/sweep.py --fixed-cadence --update-frequency 10,20,40,60
+
+import argparse
+import csv
+import itertools
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import standins
+
+MODES = ["off", "auto", "man", "heat", "cool", "fan"]
+NEVER = np.iinfo(np.int64).max // 4
+
+
+class ThermalModel:
+    def __init__(self, tau_hours=8.0, heat_rate=6.0, cool_rate=4.0, fan_rate=0.5):
+        # rates in C per hour while the appliance is on
+        self.loss = 1.0 / (tau_hours * 3600)
+        self.heat_rate = heat_rate / 3600
+        self.cool_rate = cool_rate / 3600
+        self.fan_rate = fan_rate / 3600
+
+    def decay(self, step):
+        # exp(-loss * s) for every whole second s of a weather step, shared by the engine and the check
+        return np.exp(-self.loss * np.arange(step + 1))
+
+    # Temperature the house settles at with these appliances on. Works on floats (scalar check) and arrays
+    # (engine), with the same operation order, so both give the same bits
+    def equilibrium(self, outside, heat, cool, fan):
+        return outside + (heat * self.heat_rate - cool * self.cool_rate - fan * self.fan_rate) / self.loss
+
+    def temperature(self, inside, equilibrium, decay):
+        return equilibrium + (inside - equilibrium) * decay
+
+
+# Adaptive update cadence settings (THERMO_ADAPTIVE_UPDATE). None means a fixed THERMO_UPDATE_FREQUENCY
+class Cadence:
+    def __init__(self, min_interval, max_interval, span):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.span = span
+
+
+def synthetic_weather(days, step, seed=1, mean=10.0, seasonal=12.0, daily=5.0):
+    # Seasonal and daily swings plus a slowly wandering AR(1) noise, one value every `step` seconds
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(days * 86400 / step)) * step
+    noise = np.zeros(len(t))
+    shocks = rng.normal(0, 0.3 * math.sqrt(step / 3600.0), len(t))
+    alpha = math.exp(-step / (2 * 86400.0))
+    for i in range(1, len(t)):
+        noise[i] = alpha * noise[i - 1] + shocks[i]
+    return (mean - seasonal * np.cos(2 * np.pi * t / (365 * 86400.0)) -
+            daily * np.cos(2 * np.pi * (t / 3600.0 - 4) / 24) + noise)
+
+
+def load_weather(path):
+    # One outdoor temperature (C) per line (first column of a CSV)
+    values = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            try:
+                values.append(float(row[0]))
+            except (ValueError, IndexError):
+                continue
+    return np.array(values)
+
+
+def parameter_grid(args):
+    grid = list(itertools.product(args.cold_tolerance, args.heat_tolerance, args.min_cycle, args.update_frequency))
+    columns = np.array(grid, dtype=float).T
+    return grid, columns[0], columns[1], columns[2].astype(np.int64), columns[3].astype(np.int64)
+
+
+# Seconds of [0, length) during which a + b * exp(-loss * s) is above v (a monotonic function of s)
+def time_above(a, b, v, length, decay_end, loss):
+    start = a + b
+    end = a + b * decay_end
+    with np.errstate(divide="ignore", invalid="ignore"):
+        crossing = -np.log((v - a) / b) / loss
+    crossing = np.where(np.isfinite(crossing), np.clip(crossing, 0, length), 0)
+    return np.where((start > v) & (end > v), length,
+                    np.where((start <= v) & (end <= v), 0, np.where(start > v, crossing, length - crossing)))
+
+
+# Integral of |a + b * exp(-loss * s)| over [0, length)
+def abs_integral(a, b, length, decay_end, loss):
+    whole = a * length + b * (1 - decay_end) / loss
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = -a / b
+        crosses = (b != 0) & (ratio > decay_end) & (ratio < 1)
+        crossing = np.where(crosses, -np.log(np.where(crosses, ratio, 1)) / loss, 0)
+    before = a * crossing + b * (1 - np.where(crosses, ratio, 1)) / loss
+    return np.where(crosses, np.abs(before) + np.abs(whole - before), np.abs(whole))
+
+
+# Comfort and runtime metrics of closed segments (constant weather and appliances), added up per combination
+def segment_metrics(metrics, segments, target, comfort_band, loss):
+    index, length, start, equilibrium, heating, cooling, fan = [np.concatenate(field) for field in zip(*segments)]
+    n = len(metrics["abs_error"])
+    length = length.astype(float)
+    decay_end = np.exp(-loss * length)
+    offset = equilibrium - target
+    span = start - equilibrium
+    for key, values in [("abs_error", abs_integral(offset, span, length, decay_end, loss)),
+                        ("discomfort", time_above(offset, span, comfort_band, length, decay_end, loss) +
+                         time_above(-offset, -span, comfort_band, length, decay_end, loss)),
+                        ("heat_runtime", heating * length), ("cool_runtime", cooling * length),
+                        ("fan_runtime", fan * length)]:
+        metrics[key] += np.bincount(index, weights=values, minlength=n)
+    del segments[:]
+
+
+# thermostat_decision_logic() as a table: the action taken in `mode` for every relay state (heat + 2 * cool +
+# 4 * fan) and temperature region (at or below the low threshold + 2 * at or above the high threshold + 4 * at or
+# above target + 8 * at or below target), and the relay state each action leads to (change_to())
+ACTIONS = [None, "heat_on", "cool_on", "fan_on", "heat_off", "cool_off", "fan_off"]
+
+
+def decision_tables(mode):
+    actions = np.zeros((8, 16), dtype=np.int8)
+    for state, region in itertools.product(range(8), range(16)):
+        heat, cool, fan = state & 1, state >> 1 & 1, state >> 2 & 1
+        low, high, above, below = region & 1, region >> 1 & 1, region >> 2 & 1, region >> 3 & 1
+        if low and not heat and mode in ("auto", "heat"):
+            action = "heat_on"
+        elif high and not cool and mode in ("auto", "cool"):
+            action = "cool_on"
+        elif high and not fan and mode == "fan":
+            action = "fan_on"
+        elif (above or mode in ("off", "cool", "fan")) and heat:
+            action = "heat_off"
+        elif (below or mode in ("off", "heat", "fan")) and cool:
+            action = "cool_off"
+        elif (below or mode in ("off", "heat", "cool")) and fan:
+            action = "fan_off"
+        else:
+            action = None
+        actions[state, region] = ACTIONS.index(action)
+    states = np.zeros((8, len(ACTIONS)), dtype=np.int8)
+    for state in range(8):
+        states[state] = [state, 1, 2, 4, state & ~1, state & ~2, state & ~4]
+    return actions, states
+
+
+# Vectorized thermostat over outdoor temperatures held for `step` seconds each. Returns per-combination metrics
+# and, if trace=True, the relay changes of every combination as [(second, (heat, cool, fan)), ...].
+#
+# Each loop iteration handles the next event of every combination, at its own time `at`. The helpers below work
+# on arrays of combination indexes, with the matching times.
+def evaluate(outside, step, target, mode, cold, heat_tol, min_cycle, update_frequency, model, comfort_band=1.0,
+             trace=False, cadence=None):
+    n = len(cold)
+    end = len(outside) * step
+    decay = model.decay(step)
+    actions, next_state = decision_tables(mode)
+    heat_of = np.arange(8) & 1
+    cool_of = np.arange(8) >> 1 & 1
+    fan_of = np.arange(8) >> 2 & 1
+
+    # Thermal state: inside temperature `anchor_temp` at second `anchor`, heading for `equilibrium`
+    anchor = np.zeros(n, dtype=np.int64)
+    anchor_temp = np.full(n, float(target))
+    weather = np.zeros(n, dtype=np.int64)
+    next_weather = np.full(n, step, dtype=np.int64)
+    state = np.zeros(n, dtype=np.int8)   # relays, heat + 2 * cool + 4 * fan
+    equilibrium = model.equilibrium(outside[weather], heat_of[state], cool_of[state], fan_of[state])
+    inside = anchor_temp.copy()   # actual_temp, the temperature read by the last decision
+    ticks_reset = np.zeros(n, dtype=np.int64)
+    update_interval = update_frequency.copy()
+    delay_end = np.full(n, NEVER)   # second the min cycle delay reaches 0, NEVER when changes are allowed
+    blocked_action = np.zeros(n, dtype=np.int8)   # 0 = none, else the index in ACTIONS
+    temp_trend = np.zeros(n)
+    trend_temp = anchor_temp.copy()
+    trend_ms = np.zeros(n, dtype=np.int64)
+    low = target - cold
+    high = target + heat_tol
+    # switching thresholds of the mode (see switching_thresholds()), one row each, target last
+    thresholds = []
+    if mode in ("auto", "heat"):
+        thresholds.append(low)
+    if mode in ("auto", "cool", "fan"):
+        thresholds.append(high)
+    if thresholds:
+        thresholds.append(np.full(n, float(target)))
+    thresholds = np.array(thresholds).reshape(len(thresholds), n)
+
+    metrics = dict((key, np.zeros(n)) for key in ["abs_error", "discomfort", "heat_runtime", "cool_runtime",
+                                                   "fan_runtime", "heat_cycles", "cool_cycles", "fan_cycles",
+                                                   "blocked"])
+    segments = []
+    changes = [[] for _ in range(n)] if trace else None
+
+    def temperature(index, at):
+        elapsed = at - anchor[index]
+        start = anchor_temp[index]
+        return np.where(elapsed == 0, start, model.temperature(start, equilibrium[index], decay[elapsed]))
+
+    def move_anchor(index, at):
+        # Close the segment since the last anchor and start a new one at `at`
+        temp = temperature(index, at)
+        relays = state[index]
+        segments.append((index, at - anchor[index], anchor_temp[index], equilibrium[index], heat_of[relays],
+                         cool_of[relays], fan_of[relays]))
+        if len(segments) >= 4096:
+            segment_metrics(metrics, segments, target, comfort_band, model.loss)
+        anchor_temp[index] = temp
+        anchor[index] = at
+
+    def update_equilibrium(index):
+        relays = state[index]
+        equilibrium[index] = model.equilibrium(outside[weather[index]], heat_of[relays], cool_of[relays],
+                                               fan_of[relays])
+
+    def update_cadence(index):
+        if cadence is None:
+            return
+        interval = cadence.max_interval
+        if len(thresholds):
+            trend = temp_trend[index]
+            distance = thresholds[:, index] - inside[index]
+            # the target only counts while an appliance is on; NaN rows are ignored by fmin
+            distance[-1, state[index] == 0] = np.nan
+            closer = cadence.max_interval * np.abs(distance) / cadence.span
+            towards = distance * trend > 0
+            closer = np.where(towards, np.fmin(closer, distance / trend / 2), closer)
+            interval = np.fmin(interval, np.fmin.reduce(closer, axis=0))
+            interval = np.where(towards.any(axis=0), interval, np.maximum(interval, update_frequency[index]))
+        update_interval[index] = np.minimum(cadence.max_interval, np.maximum(cadence.min_interval, interval))
+
+    def update_trend(index, at):
+        now_ms = at * 1000
+        elapsed = (now_ms - trend_ms[index]) / 1000
+        current = inside[index]
+        moved = elapsed > 0
+        temp_trend[index[moved]] = (current[moved] - trend_temp[index[moved]]) / elapsed[moved]
+        trend_temp[index] = current
+        trend_ms[index] = now_ms
+
+    def decide(index, at, cadence_first=True):
+        # thermostat_decision_logic() followed by change_to()
+        temp = temperature(index, at)
+        inside[index] = temp
+        if cadence_first:
+            update_cadence(index)
+        region = ((temp <= low[index]) + (temp >= high[index]) * 2 + (temp >= target) * 4 +
+                  (temp <= target) * 8)
+        relays = state[index]
+        action = actions[relays, region]
+        change = action != 0
+        if not change.any():
+            return
+        allowed = delay_end[index] == NEVER
+        # a deferred change is counted once per min cycle, like change_to()
+        blocked = change & ~allowed
+        metrics["blocked"][index] += blocked & (action != blocked_action[index])
+        blocked_action[index[blocked]] = action[blocked]
+        change &= allowed
+        if not change.any():
+            return
+        changed = index[change]
+        at = at[change]
+        action = action[change]
+        move_anchor(changed, at)
+        blocked_action[changed] = 0
+        metrics["heat_cycles"][changed] += action == 1
+        metrics["cool_cycles"][changed] += action == 2
+        metrics["fan_cycles"][changed] += action == 3
+        state[changed] = next_state[relays[change], action]
+        update_equilibrium(changed)
+        delay_end[changed] = np.where(min_cycle[changed] > 0, at + min_cycle[changed], NEVER)
+        if trace:
+            for combination, second in zip(changed, at):
+                relays = int(state[combination])
+                changes[combination].append((int(second), (relays & 1, relays >> 1 & 1, relays >> 2 & 1)))
+
+    # divisions by a zero trend and NaN distances in update_cadence() are expected
+    np_errors = np.seterr(divide="ignore", invalid="ignore")
+    everyone = np.arange(n)
+    decide(everyone, np.zeros(n, dtype=np.int64))
+    due_at = update_interval.copy()
+    while True:
+        at = np.minimum(np.minimum(next_weather, due_at), delay_end)
+        active = at < end
+        if not active.any():
+            break
+        # a new weather value first, then the min cycle expiry, then the main loop decision, like the Core2
+        index = (active & (next_weather == at)).nonzero()[0]
+        if len(index):
+            move_anchor(index, at[index])
+            weather[index] += 1
+            next_weather[index] += step
+            update_equilibrium(index)
+        index = (active & (delay_end == at)).nonzero()[0]
+        if len(index):
+            delay_end[index] = NEVER
+            blocked_action[index] = 0
+            decide(index, at[index])
+            due_at[index] = ticks_reset[index] + update_interval[index]
+        index = (active & (due_at <= at)).nonzero()[0]
+        if len(index):
+            # the interval computed by the decision itself is replaced right away, so it is not computed here
+            decide(index, at[index], cadence_first=False)
+            update_trend(index, at[index])
+            update_cadence(index)
+            ticks_reset[index] = at[index]
+            due_at[index] = at[index] + update_interval[index]
+    move_anchor(everyone, np.full(n, end))
+    segment_metrics(metrics, segments, target, comfort_band, model.loss)
+    np.seterr(**np_errors)
+
+    result = {
+        "comfort_mae": metrics["abs_error"] / max(end, 1),
+        "discomfort_h": metrics["discomfort"] / 3600,
+        "heat_runtime_h": metrics["heat_runtime"] / 3600,
+        "cool_runtime_h": metrics["cool_runtime"] / 3600,
+        "fan_runtime_h": metrics["fan_runtime"] / 3600,
+        "heat_cycles": metrics["heat_cycles"],
+        "cool_cycles": metrics["cool_cycles"],
+        "fan_cycles": metrics["fan_cycles"],
+        "blocked": metrics["blocked"],
+    }
+    return result, changes
+
+
+# Run one combination through Thermostat.py on stand-in modules, with the same thermal model. The temperature is
+# computed when the Core2 reads it, re-anchored at every weather value and at the read that preceded a relay change
+# (the decision that made it), exactly like the engine.
+def scalar_changes(outside, step, target, mode, cold, heat_tol, min_cycle, update_frequency, model, path, cadence):
+    device = standins.Device(path=path)
+    mod = device.mod
+    mod.TRACE_ENABLED = False
+    mod.THERMO_ADAPTIVE_UPDATE = cadence is not None
+    if cadence is not None:
+        mod.THERMO_MIN_UPDATE_FREQUENCY = cadence.min_interval
+        mod.THERMO_MAX_UPDATE_FREQUENCY = cadence.max_interval
+        mod.THERMO_ADAPTIVE_SPAN = cadence.span
+    mod.THERMO_COLD_TOLERANCE = cold
+    mod.THERMO_HEAT_TOLERANCE = heat_tol
+    mod.THERMO_MIN_CYCLE = min_cycle
+    mod.THERMO_UPDATE_FREQUENCY = update_frequency
+    decay = model.decay(step)
+    house = {"anchor": 0, "temp": float(target), "weather": 0, "appliances": (0, 0, 0), "read": 0}
+
+    def temperature(at):
+        if at == house["anchor"]:
+            return house["temp"]
+        equilibrium = model.equilibrium(float(outside[house["weather"]]), *house["appliances"])
+        return model.temperature(house["temp"], equilibrium, float(decay[at - house["anchor"]]))
+
+    def provider(name, value):
+        if name != "temperature":
+            return value
+        at = device.clock.ms // 1000
+        # the relays are read before thermostat_init() has set them up
+        appliances = tuple(getattr(mod, state, 0) for state in ("heating_state", "cooling_state", "fan_state"))
+        if appliances != house["appliances"]:
+            house["temp"] = temperature(house["read"])
+            house["anchor"] = house["read"]
+            house["appliances"] = appliances
+        while (house["weather"] + 1) * step <= at:
+            house["temp"] = temperature((house["weather"] + 1) * step)
+            house["anchor"] = (house["weather"] + 1) * step
+            house["weather"] += 1
+        house["read"] = at
+        return temperature(at)
+
+    device.sensor.provider = provider
+    device.start()
+    device.timers.running["main_loop"] = [1000, device.clock.ms + 1000]
+    device.mqtt.callbacks[mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX + mod.TOPIC_TEMPERATURE_COMMAND](str(target))
+    device.mqtt.callbacks[mod.DEFAULT_TOPIC_THERMOSTAT_PREFIX + mod.TOPIC_MODE_COMMAND](
+        "fan_only" if mode == "fan" else mode)
+    changes = []
+    appliances = (0, 0, 0)
+    for second in range(len(outside) * step):
+        if second:
+            standins.run_until([device], second * 1000)
+        if (mod.heating_state, mod.cooling_state, mod.fan_state) != appliances:
+            appliances = (mod.heating_state, mod.cooling_state, mod.fan_state)
+            changes.append((second, appliances))
+    return changes, sum(mod.stats[appliance]["blocked"] for appliance in mod.STATS_APPLIANCES)
+
+
+def check(args, outside, step, model, grid, cold, heat_tol, min_cycle, update_frequency, cadence):
+    outside = outside[:max(1, int(args.check_days * 86400 / step))]
+    result, changes = evaluate(outside, step, args.target, args.mode, cold, heat_tol, min_cycle, update_frequency,
+                               model, trace=True, cadence=cadence)
+    picks = np.linspace(0, len(grid) - 1, min(args.check, len(grid))).astype(int)
+    ok = True
+    for index in picks:
+        combination = grid[index]
+        expected, blocked = scalar_changes(outside, step, args.target, args.mode, combination[0], combination[1],
+                                           int(combination[2]), int(combination[3]), model, args.thermostat, cadence)
+        # several changes in the same second show up as one in the check
+        vector = [change for i, change in enumerate(changes[index])
+                  if i + 1 == len(changes[index]) or changes[index][i + 1][0] != change[0]]
+        mismatch = next((i for i in range(min(len(vector), len(expected))) if vector[i] != expected[i]), None)
+        if mismatch is None and len(vector) != len(expected):
+            mismatch = min(len(vector), len(expected))
+        if mismatch is not None:
+            ok = False
+            print("check %s: MISMATCH at change %d: engine %s, Thermostat.py %s" % (
+                format_combination(combination), mismatch, vector[mismatch:mismatch + 1],
+                expected[mismatch:mismatch + 1]))
+        elif blocked != result["blocked"][index]:
+            ok = False
+            print("check %s: MISMATCH blocked changes: engine %d, Thermostat.py %d" % (
+                format_combination(combination), result["blocked"][index], blocked))
+        else:
+            print("check %s: OK (%d s, %d changes, %d blocked)" % (format_combination(combination),
+                                                                   len(outside) * step, len(vector), blocked))
+    return ok
+
+
+def format_combination(combination):
+    return "cold=%g heat=%g min_cycle=%ds update=%ds" % (combination[0], combination[1], combination[2],
+                                                        combination[3])
+
+
+def float_list(text):
+    return [float(value) for value in text.split(",")]
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep thermostat tolerances, min cycle and update frequency")
+    parser.add_argument("--thermostat", default=standins.THERMOSTAT_PATH, help="path to Thermostat.py")
+    parser.add_argument("--cold-tolerance", type=float_list, default=[0.25, 0.5, 0.75, 1.0, 1.5, 2.0])
+    parser.add_argument("--heat-tolerance", type=float_list, default=[0.25, 0.5, 0.75, 1.0, 1.5, 2.0])
+    parser.add_argument("--min-cycle", type=int_list, default=[0, 120, 300, 600, 900], help="seconds")
+    parser.add_argument("--update-frequency", type=int_list,
+                        help="seconds (default: 20,40,60 with --fixed-cadence, else as in Thermostat.py)")
+    parser.add_argument("--target", type=float, default=21.0)
+    parser.add_argument("--mode", choices=[m for m in MODES if m != "man"], default="auto")
+    parser.add_argument("--weather", action="append", help="outdoor temperature trace (repeatable)")
+    parser.add_argument("--weather-step", type=int, default=3600, help="seconds between weather values")
+    parser.add_argument("--days", type=float, default=365, help="length of the synthetic weather trace")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tau-hours", type=float, default=8.0, help="house time constant")
+    parser.add_argument("--heat-rate", type=float, default=6.0, help="C/hour while heating")
+    parser.add_argument("--cool-rate", type=float, default=4.0, help="C/hour while cooling")
+    parser.add_argument("--comfort-band", type=float, default=1.0, help="C from target counted as discomfort")
+    parser.add_argument("--top", type=int, default=15, help="combinations to print")
+    parser.add_argument("--out", help="write all combinations as CSV")
+    parser.add_argument("--check", type=int, default=0, help="cross-check N combinations against Thermostat.py")
+    parser.add_argument("--check-days", type=float, default=1)
+    parser.add_argument("--fixed-cadence", action="store_true",
+                        help="evaluate with THERMO_ADAPTIVE_UPDATE = False (default: as in Thermostat.py)")
+    parser.add_argument("--min-update", type=int, help="THERMO_MIN_UPDATE_FREQUENCY (default: as in Thermostat.py)")
+    parser.add_argument("--max-update", type=int, help="THERMO_MAX_UPDATE_FREQUENCY (default: as in Thermostat.py)")
+    parser.add_argument("--adaptive-span", type=float, help="THERMO_ADAPTIVE_SPAN (default: as in Thermostat.py)")
+    args = parser.parse_args()
+
+    # The cadence settings of the firmware as shipped, unless overridden
+    firmware = standins.Device(path=args.thermostat).mod
+    cadence = None
+    if firmware.THERMO_ADAPTIVE_UPDATE and not args.fixed_cadence:
+        cadence = Cadence(args.min_update or firmware.THERMO_MIN_UPDATE_FREQUENCY,
+                          args.max_update or firmware.THERMO_MAX_UPDATE_FREQUENCY,
+                          args.adaptive_span or firmware.THERMO_ADAPTIVE_SPAN)
+    # With the adaptive cadence THERMO_UPDATE_FREQUENCY is only the floor of the interval away from the thresholds
+    # and barely changes the results, so it is not swept unless asked for
+    if args.update_frequency is None:
+        args.update_frequency = [firmware.THERMO_UPDATE_FREQUENCY] if cadence else [20, 40, 60]
+
+    model = ThermalModel(args.tau_hours, args.heat_rate, args.cool_rate)
+    if args.weather:
+        step = args.weather_step
+        traces = [load_weather(path) for path in args.weather]
+    else:
+        step = 3600
+        traces = [synthetic_weather(args.days, step, args.seed)]
+    grid, cold, heat_tol, min_cycle, update_frequency = parameter_grid(args)
+
+    if args.check:
+        ok = check(args, traces[0], step, model, grid, cold, heat_tol, min_cycle, update_frequency, cadence)
+        if not ok:
+            return 1
+
+    started = time.perf_counter()
+    totals = None
+    for outside in traces:
+        result, changes = evaluate(outside, step, args.target, args.mode, cold, heat_tol, min_cycle, update_frequency,
+                                   model, args.comfort_band, cadence=cadence)
+        if totals is None:
+            totals = result
+        else:
+            for key in totals:
+                totals[key] = totals[key] + result[key]
+    if len(traces) > 1:
+        totals["comfort_mae"] = totals["comfort_mae"] / len(traces)
+    elapsed = time.perf_counter() - started
+    days = sum(len(outside) for outside in traces) * step / 86400.0
+    print("%d combinations x %.0f days in %.1f s (%s update cadence)" % (
+        len(grid), days, elapsed, "adaptive" if cadence else "fixed"))
+
+    keys = ["comfort_mae", "discomfort_h", "heat_cycles", "cool_cycles", "heat_runtime_h", "cool_runtime_h",
+            "blocked"]
+    order = np.lexsort((totals["heat_cycles"] + totals["cool_cycles"], np.round(totals["comfort_mae"], 2)))
+    print("%-46s %s" % ("combination", " ".join("%14s" % key for key in keys)))
+    for index in order[:args.top]:
+        print("%-46s %s" % (format_combination(grid[index]), " ".join("%14.2f" % totals[key][index] for key in keys)))
+
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["cold_tolerance", "heat_tolerance", "min_cycle", "update_frequency"] + sorted(totals))
+            for index, combination in enumerate(grid):
+                writer.writerow(list(combination) + ["%.4f" % totals[key][index] for key in sorted(totals)])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())